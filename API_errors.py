@@ -3,6 +3,11 @@ ERR_400_INVALID_ATTR = {
     "status_code": 400
 }
 
+ERR_400_INVALID_QUERY = {
+    "description": "A query parameter is invalid or not supported.",
+    "status_code": 400
+}
+
 ERR_403_NAME_EXISTS = {
     "description": "The provided name attribute already exists.", 
     "status_code": 403
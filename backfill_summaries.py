@@ -0,0 +1,96 @@
+"""Copy load summaries onto boats and carrier names onto loads.
+
+Usage: python backfill_summaries.py [--dry-run] [--batch-size N]
+
+Boats written before load_summaries existed list only load ids, and loads
+only their carrier's id, so reading them falls back to looking the other
+entity up. This job walks both kinds a batch at a time and, in one
+transaction per batch, writes any copy that is missing or stale. Running
+it again is safe.
+"""
+import argparse
+
+import constants
+from db import get_client
+from utils import load_summary, run_in_transaction, touch
+
+
+def lookup(client, kind, ids):
+    """Read entities by id in lookups of at most max_lookup_keys, keyed by id"""
+    ids = list(dict.fromkeys(ids))
+    found = {}
+    for start in range(0, len(ids), constants.max_lookup_keys):
+        keys = [client.key(kind, i) for i in ids[start:start + constants.max_lookup_keys]]
+        found.update((entity.key.id, entity) for entity in client.get_multi(keys))
+    return found
+
+
+def backfill_boats(client, keys, dry_run):
+    def backfill():
+        boats = client.get_multi(keys)
+        loads = lookup(client, constants.loads, [i for boat in boats for i in boat["loads"]])
+        changed = []
+        for boat in boats:
+            summaries = [load_summary(loads[i]) for i in boat["loads"] if i in loads]
+            if boat.get("load_summaries") != summaries:
+                boat["load_summaries"] = summaries
+                changed.append(boat)
+        if changed and not dry_run:
+            touch(*changed)
+            client.put_multi(changed)
+        return len(changed)
+    return run_in_transaction(client, backfill)
+
+
+def backfill_loads(client, keys, dry_run):
+    def backfill():
+        loads = client.get_multi(keys)
+        boats = lookup(client, constants.boats, [load["carrier"] for load in loads if load["carrier"]])
+        changed = []
+        for load in loads:
+            boat = boats.get(load["carrier"]) if load["carrier"] else None
+            name = boat["name"] if boat else None
+            if "carrier_name" not in load or load["carrier_name"] != name:
+                load["carrier_name"] = name
+                changed.append(load)
+        if changed and not dry_run:
+            touch(*changed)
+            client.put_multi(changed)
+        return len(changed)
+    return run_in_transaction(client, backfill)
+
+
+def walk(client, kind, batch_size, fn, dry_run):
+    """Apply fn to the keys of every entity of kind, one page of keys at a time"""
+    query = client.query(kind=kind)
+    query.keys_only()
+    total = 0
+    cursor = None
+    while True:
+        iterator = query.fetch(limit=batch_size, start_cursor=cursor)
+        keys = [entity.key for entity in next(iterator.pages)]
+        if keys:
+            total += fn(client, keys, dry_run)
+        cursor = iterator.next_page_token
+        if not cursor or len(keys) < batch_size:
+            return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report without writing")
+    parser.add_argument("--batch-size", type=int, default=250,
+                        help="entities per transaction (at most %d)" % constants.max_mutations)
+    args = parser.parse_args()
+    batch_size = min(args.batch_size, constants.max_mutations)
+
+    client = get_client()
+    verb = "Would update" if args.dry_run else "Updated"
+    boats = walk(client, constants.boats, batch_size, backfill_boats, args.dry_run)
+    print("%s %d boats" % (verb, boats))
+    loads = walk(client, constants.loads, batch_size, backfill_loads, args.dry_run)
+    print("%s %d loads" % (verb, loads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Per-endpoint benchmark with Datastore RPC-count regression gates.
+
+Usage: python benchmarks/bench_api.py [--iterations N] [--only NAME] [--warm-cache]
+                                      [--rpc-latency SECONDS] [--update-budget]
+
+Every route is driven through the Flask test client against the in-memory
+storage backend, with JWT verification stubbed out. Fan-out shapes cover
+boats with 0, 10 and 500 loads and users with many boats. For each scenario
+the script reports requests per second, p50/p99 latency and Datastore RPCs
+per request.
+
+RPC counts are compared with benchmarks/rpc_budget.json and the script
+exits non-zero if any scenario needs more RPCs than its budget. After an
+intentional change, run with --update-budget to record the new counts.
+By default the entity and page caches are cleared before every request, so counts
+show the cold path; --warm-cache leaves it populated.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpc_budget.json")
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("AUTH0_DOMAIN", "bench.auth0.com")
+os.environ.setdefault("AUTH0_CLIENT_ID", "bench-client")
+
+import boat
+import constants
+import db
+import main
+from cache import entity_cache, page_cache
+
+OWNER = "auth0|bench-owner"
+JSON = {"Content-Type": constants.application_json, "Authorization": "Bearer " + OWNER}
+
+
+def fake_verify_jwt(request):
+    return {"sub": request.headers["Authorization"].split()[1], "name": "Bench Owner"}
+
+
+class Fixture:
+    """Seeds the in-memory store and builds entities for scenarios"""
+    def __init__(self, client):
+        self.client = client
+
+    def loads(self, count, carrier=None, carrier_name=None):
+        keys = self.client.allocate_ids(self.client.key(constants.loads), count) if count else []
+        loads = []
+        for i, key in enumerate(keys):
+            load = db.new_entity(key)
+            load.update({"volume": i, "carrier": carrier, "carrier_name": carrier_name,
+                         "item": "Load #%d" % i, "creation_date": "01-01-2000"})
+            loads.append(load)
+        self.put_multi(loads)
+        return [load.key.id for load in loads]
+
+    def boat(self, load_count=0, owner=OWNER):
+        key = self.client.allocate_ids(self.client.key(constants.boats), 1)[0]
+        name = "Boat %d" % key.id
+        load_ids = self.loads(load_count, carrier=key.id, carrier_name=name)
+        boat = db.new_entity(key)
+        boat.update({"name": name, "length": 30, "date_built": "01-01-2000", "owner": owner,
+                     "loads": load_ids,
+                     "load_summaries": [{"id": i, "item": "Load #%d" % n} for n, i in enumerate(load_ids)],
+                     "load_volume": sum(range(load_count))})
+        self.client.put(boat)
+        self.user_boats(owner, [key.id])
+        return key.id, load_ids
+
+    def user_boats(self, sub, boat_ids):
+        user = self.client.get(self.client.key(constants.users, sub))
+        if user is None:
+            user = db.new_entity(self.client.key(constants.users, sub))
+            user.update({"sub": sub, "name": sub, "boats": []})
+        user["boats"].extend(boat_ids)
+        self.client.put(user)
+
+    def assign(self, boat_id, load_ids):
+        """Put exactly load_ids on the boat"""
+        self._relate(boat_id, load_ids, boat_id)
+
+    def unassign(self, boat_id, load_ids):
+        """Take load_ids off the boat and leave it empty"""
+        self._relate(boat_id, load_ids, None)
+
+    def _relate(self, boat_id, load_ids, carrier):
+        loads = self.client.get_multi([self.client.key(constants.loads, i) for i in load_ids])
+        boat = self.client.get(self.client.key(constants.boats, boat_id))
+        for load in loads:
+            load["carrier"] = carrier
+            load["carrier_name"] = boat["name"] if carrier else None
+        boat["loads"] = [load.key.id for load in loads] if carrier else []
+        boat["load_summaries"] = [{"id": load.key.id, "item": load["item"]} for load in loads] if carrier else []
+        boat["load_volume"] = sum(load["volume"] for load in loads) if carrier else 0
+        self.put_multi(loads + [boat])
+
+    def put_multi(self, entities):
+        # The store rejects commits larger than Datastore allows
+        for start in range(0, len(entities), constants.max_mutations):
+            self.client.put_multi(entities[start:start + constants.max_mutations])
+
+
+def scenarios(fx, http):
+    """Yield (name, setup, request) triples; setup runs untimed before each request"""
+    noop = lambda: None
+
+    # Boats owned by the benchmark owner, one per fan-out shape
+    shapes = {n: fx.boat(n) for n in (0, 10, 500)}
+    for n, (boat_id, _) in shapes.items():
+        yield ("GET /boats/<id> loads=%d" % n, noop,
+               lambda b=boat_id: http.get("/boats/%d" % b, headers=JSON))
+        yield ("GET /boats/<id> loads=%d expand" % n, noop,
+               lambda b=boat_id: http.get("/boats/%d?expand=loads" % b, headers=JSON))
+
+    # Exports, before the write scenarios below change how many entities exist
+    yield ("GET /loads/export expand", noop, lambda: http.get("/loads/export?expand=carrier", headers=JSON))
+    yield ("GET /boats/export expand", noop, lambda: http.get("/boats/export?expand=loads", headers=JSON))
+
+    # Polls that already hold the current representation
+    etags = {}
+    def remember(url):
+        etags[url] = http.get(url, headers=JSON).headers["ETag"]
+    polls = {"GET /boats/<id> loads=500 expand 304": "/boats/%d?expand=loads" % shapes[500][0],
+             "GET /boats limit=5 expand 304": "/boats?limit=5&expand=loads"}
+    for name, url in polls.items():
+        yield (name, lambda u=url: remember(u),
+               lambda u=url: http.get(u, headers=dict(JSON, **{"If-None-Match": etags[u]})))
+
+    # Aggregates, read from counters whatever the fleet size
+    yield ("GET /boats/<id>/stats loads=500", noop,
+           lambda: http.get("/boats/%d/stats" % shapes[500][0], headers=JSON))
+    yield ("GET /boats/stats", noop, lambda: http.get("/boats/stats", headers=JSON))
+
+    yield ("GET /boats limit=5", noop, lambda: http.get("/boats?limit=5", headers=JSON))
+    yield ("GET /boats limit=5 expand", noop, lambda: http.get("/boats?limit=5&expand=loads", headers=JSON))
+    yield ("GET /boats limit=5 fields=name", noop, lambda: http.get("/boats?limit=5&fields=name", headers=JSON))
+
+    for n in (10, 500):
+        boat_id, _ = fx.boat(0)
+        spare = fx.loads(n)
+        yield ("PATCH /boats/<id> attach=%d" % n,
+               lambda b=boat_id, l=spare: fx.unassign(b, l),
+               lambda b=boat_id, l=spare: http.patch("/boats/%d" % b, headers=JSON, json={"loads": l}))
+
+        yield ("PUT /boats/<id> loads=%d" % n,
+               lambda b=boat_id, l=spare: fx.assign(b, l),
+               lambda b=boat_id: http.put("/boats/%d" % b, headers=JSON,
+                                          json={"name": "Renamed", "length": 31, "date_built": "02-02-2000"}))
+
+    for n in (0, 500):
+        pending = []
+        yield ("DELETE /boats/<id> loads=%d" % n,
+               lambda n=n, p=pending: p.append(fx.boat(n)[0]),
+               lambda p=pending: http.delete("/boats/%d" % p.pop(), headers=JSON))
+
+    boat_id, _ = fx.boat(0)
+    load_id = fx.loads(1)[0]
+    yield ("PUT /boats/<id>/loads/<id>",
+           lambda: fx.unassign(boat_id, [load_id]),
+           lambda: http.put("/boats/%d/loads/%d" % (boat_id, load_id), headers=JSON))
+    yield ("DELETE /boats/<id>/loads/<id>",
+           lambda: fx.assign(boat_id, [load_id]),
+           lambda: http.delete("/boats/%d/loads/%d" % (boat_id, load_id), headers=JSON))
+
+    yield ("POST /boats", noop,
+           lambda: http.post("/boats", headers=JSON,
+                             json={"name": "New", "length": 10, "date_built": "01-01-2000"}))
+
+    yield ("GET /loads limit=5", noop, lambda: http.get("/loads?limit=5", headers=JSON))
+    yield ("GET /loads limit=5 expand", noop, lambda: http.get("/loads?limit=5&expand=carrier", headers=JSON))
+    carried = shapes[10][1][0]
+    yield ("GET /loads/<id> carried", noop, lambda: http.get("/loads/%d" % carried, headers=JSON))
+    yield ("GET /loads/<id> carried expand", noop,
+           lambda: http.get("/loads/%d?expand=carrier" % carried, headers=JSON))
+    yield ("POST /loads", noop,
+           lambda: http.post("/loads", headers=JSON,
+                             json={"volume": 5, "item": "LEGO", "creation_date": "10-18-2021"}))
+    yield ("PUT /loads/<id>", noop,
+           lambda: http.put("/loads/%d" % carried, headers=JSON,
+                            json={"volume": 6, "item": "DUPLO", "creation_date": "10-18-2021"}))
+    yield ("PATCH /loads/<id>", noop,
+           lambda: http.patch("/loads/%d" % carried, headers=JSON, json={"volume": 7}))
+    pending_loads = []
+    yield ("DELETE /loads/<id> unassigned",
+           lambda: pending_loads.append(fx.loads(1)[0]),
+           lambda: http.delete("/loads/%d" % pending_loads.pop(), headers=JSON))
+
+    # Users with many boats
+    for i in range(50):
+        sub = "auth0|fleet-%d" % i
+        for _ in range(5):
+            fx.boat(0, owner=sub)
+    big = "auth0|big-fleet"
+    for _ in range(200):
+        fx.boat(0, owner=big)
+    yield ("GET /users limit=10", noop, lambda: http.get("/users?limit=10", headers=JSON))
+    yield ("GET /users stream", noop, lambda: http.get("/users", headers=JSON))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(args):
+    main.app.config["TESTING"] = True
+    boat.verify_jwt = fake_verify_jwt
+    client = db.get_client()
+    client.rpc_latency = args.rpc_latency
+    http = main.app.test_client()
+    fx = Fixture(client)
+
+    results = {}
+    for name, setup, request in scenarios(fx, http):
+        if args.only and args.only not in name:
+            continue
+        latencies = []
+        rpcs = []
+        breakdown = None
+        for _ in range(args.iterations):
+            setup()
+            if not args.warm_cache:
+                entity_cache.clear()
+                page_cache.clear()
+            client.reset_counters()
+            start = time.perf_counter()
+            response = request()
+            # Read the body inside the timing so streamed responses are included
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise SystemExit("%s returned %d: %s" % (name, response.status_code, response.get_data(as_text=True)))
+            rpcs.append(client.rpc_count())
+            breakdown = dict(client.counters)
+        results[name] = {
+            "rps": len(latencies) / sum(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "rpcs": max(rpcs),
+            "breakdown": breakdown,
+        }
+        r = results[name]
+        print("%-40s %9.0f req/s  p50 %8.2f ms  p99 %8.2f ms  rpcs %4d  %s" % (
+            name, r["rps"], r["p50_ms"], r["p99_ms"], r["rpcs"],
+            " ".join("%s=%d" % item for item in sorted(r["breakdown"].items()))))
+    return results
+
+
+def check_budget(results, update):
+    budget = {}
+    if os.path.exists(BUDGET_FILE):
+        with open(BUDGET_FILE) as f:
+            budget = json.load(f)
+    if update:
+        budget.update({name: r["rpcs"] for name, r in results.items()})
+        with open(BUDGET_FILE, "w") as f:
+            json.dump(budget, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Recorded RPC budget for %d scenarios in %s" % (len(results), BUDGET_FILE))
+        return 0
+    failures = [(name, r["rpcs"], budget[name]) for name, r in results.items()
+                if name in budget and r["rpcs"] > budget[name]]
+    for name, actual, allowed in failures:
+        print("FAIL: %s needs %d RPCs, budget is %d" % (name, actual, allowed))
+    missing = [name for name in results if name not in budget]
+    for name in missing:
+        print("note: no RPC budget recorded for %s" % name)
+    return 1 if failures else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--only", help="run scenarios whose name contains this text")
+    parser.add_argument("--warm-cache", action="store_true", help="keep the entity and page caches between requests")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds added to every RPC")
+    parser.add_argument("--update-budget", action="store_true", help="record current RPC counts as the budget")
+    args = parser.parse_args()
+    results = run(args)
+    if args.warm_cache:
+        # Warm-cache counts depend on request order, so they are not gated
+        return 0
+    return check_budget(results, args.update_budget)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,73 @@
+"""Compare verify_jwt throughput with the verified-claims cache on and off.
+
+Usage: python benchmarks/bench_jwt.py [iterations]
+
+A throwaway RSA key stands in for Auth0 so no network access is needed.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("AUTH0_DOMAIN", "bench.auth0.com")
+os.environ.setdefault("AUTH0_CLIENT_ID", "bench-client")
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk
+from jose import jwt as jose_jwt
+
+import jwt
+
+
+class FakeRequest:
+    def __init__(self, token):
+        self.headers = {"Authorization": "Bearer " + token}
+
+
+def make_token():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    public_jwk = jwk.construct(public_pem, "RS256").to_dict()
+    public_jwk.update({"kid": "bench", "use": "sig"})
+    jwt.jwks_cache.fetch = lambda: {"keys": [public_jwk]}
+
+    claims = {
+        "sub": "auth0|bench",
+        "aud": os.environ["AUTH0_CLIENT_ID"],
+        "iss": "https://" + os.environ["AUTH0_DOMAIN"] + "/",
+        "exp": int(time.time()) + 3600,
+    }
+    return jose_jwt.encode(claims, private_pem, algorithm="RS256", headers={"kid": "bench"})
+
+
+def run(req, iterations, maxsize):
+    jwt.claims_cache.maxsize = maxsize
+    jwt.claims_cache.clear()
+    jwt.verify_jwt(req)  # warm the JWKS cache
+    start = time.perf_counter()
+    for _ in range(iterations):
+        jwt.verify_jwt(req)
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    req = FakeRequest(make_token())
+    uncached = run(req, iterations, 0)
+    cached = run(req, iterations, jwt.CLAIMS_CACHE_SIZE or 1024)
+    print("verifications/s  cache off: %10.0f" % uncached)
+    print("verifications/s  cache on:  %10.0f" % cached)
+    print("speedup: %.1fx" % (cached / uncached))
+
+
+if __name__ == "__main__":
+    main()
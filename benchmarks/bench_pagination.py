@@ -0,0 +1,74 @@
+"""Page latency of offset paging versus cursor paging at increasing depth.
+
+Usage: python benchmarks/bench_pagination.py [limit]
+
+Runs against the Datastore configured for google.cloud.datastore; point
+DATASTORE_EMULATOR_HOST at a local emulator to avoid touching real data.
+Entities are written to a separate namespace and deleted afterwards.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.cloud import datastore
+
+import constants
+from utils import fetch_page
+
+NAMESPACE = "bench-pagination"
+DEPTHS = [10, 100, 1000]
+
+
+def seed(client, count):
+    keys = client.allocate_ids(client.key(constants.loads), count)
+    entities = []
+    for i, key in enumerate(keys):
+        entity = datastore.Entity(key=key)
+        entity.update({"volume": i, "carrier": None, "item": "Load #%d" % i,
+                       "creation_date": "01-01-2000"})
+        entities.append(entity)
+    for start in range(0, len(entities), 500):
+        client.put_multi(entities[start:start + 500])
+    return keys
+
+
+def cursor_at_depth(client, limit, depth):
+    # Walk to the page before the target depth to obtain its cursor
+    query = client.query(kind=constants.loads)
+    cursor = None
+    for _ in range(depth):
+        _, cursor = fetch_page(query, limit, cursor)
+    return cursor
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    client = datastore.Client(namespace=NAMESPACE)
+    keys = seed(client, limit * (max(DEPTHS) + 1))
+    try:
+        print("%8s %14s %14s" % ("depth", "offset ms", "cursor ms"))
+        for depth in DEPTHS:
+            query = client.query(kind=constants.loads)
+            cursor = cursor_at_depth(client, limit, depth)
+            offset_ms = timed(lambda: fetch_page(query, limit, offset=depth * limit))
+            cursor_ms = timed(lambda: fetch_page(query, limit, cursor))
+            print("%8d %14.2f %14.2f" % (depth, offset_ms, cursor_ms))
+    finally:
+        for start in range(0, len(keys), 500):
+            client.delete_multi(keys[start:start + 500])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Time building and encoding boat and load representations.
+
+Usage: python benchmarks/bench_serialize.py [iterations]
+
+Pages of 1, 100 and 1000 entities are represented with loads and carriers
+expanded from their stored copies, then encoded with each available JSON
+backend. No storage or network is involved.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("AUTH0_DOMAIN", "bench.auth0.com")
+os.environ.setdefault("AUTH0_CLIENT_ID", "bench-client")
+
+from flask import Flask
+from google.cloud import datastore
+
+import constants
+import reprs
+from utils import create_boat_reprs, create_load_reprs, dumps
+
+PAGE_SIZES = (1, 100, 1000)
+LOADS_PER_BOAT = 10
+
+
+def make_boats(count):
+    boats = []
+    for i in range(1, count + 1):
+        boat = datastore.Entity(key=datastore.Key(constants.boats, i, project="bench"))
+        load_ids = [i * 100 + n for n in range(LOADS_PER_BOAT)]
+        boat.update({
+            "name": "boat %d" % i,
+            "length": 28,
+            "date_built": "2021-11-01",
+            "owner": "auth0|bench-owner",
+            "loads": load_ids,
+            "load_summaries": [{"id": n, "item": "item %d" % n} for n in load_ids],
+            "version": 1,
+        })
+        boats.append(boat)
+    return boats
+
+
+def make_loads(count):
+    loads = []
+    for i in range(1, count + 1):
+        load = datastore.Entity(key=datastore.Key(constants.loads, i, project="bench"))
+        load.update({
+            "volume": 5,
+            "carrier": i,
+            "carrier_name": "boat %d" % i,
+            "item": "item %d" % i,
+            "creation_date": "2021-11-01",
+            "version": 1,
+        })
+        loads.append(load)
+    return loads
+
+
+def run(app, build, entities, iterations):
+    """Return the mean seconds per page spent building and encoding"""
+    built = encoded = 0.0
+    for _ in range(iterations):
+        with app.test_request_context("/"):
+            start = time.perf_counter()
+            data = build(entities)
+            middle = time.perf_counter()
+            dumps(data)
+            end = time.perf_counter()
+        built += middle - start
+        encoded += end - middle
+    return built / iterations, encoded / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    app = Flask(__name__)
+    backends = ["json"]
+    try:
+        import orjson  # noqa: F401
+        backends.append("orjson")
+    except ImportError:
+        print("orjson is not installed; timing the json backend only")
+
+    cases = (
+        ("boats", make_boats, lambda boats: {"boats": create_boat_reprs(boats, expand=("loads",))}),
+        ("loads", make_loads, lambda loads: {"loads": create_load_reprs(loads, expand=("carrier",))}),
+    )
+    print("%-8s %6s %-8s %12s %12s %12s" % ("kind", "items", "backend", "build ms", "encode ms", "total ms"))
+    for kind, make, build in cases:
+        for size in PAGE_SIZES:
+            entities = make(size)
+            # Keep the total work per case roughly constant
+            count = max(1, iterations * 100 // max(size, 100))
+            for backend in backends:
+                reprs.set_backend(backend)
+                built, encoded = run(app, build, entities, count)
+                print("%-8s %6d %-8s %12.3f %12.3f %12.3f"
+                      % (kind, size, backend, built * 1000, encoded * 1000, (built + encoded) * 1000))
+    reprs.set_backend(None)
+
+
+if __name__ == "__main__":
+    main()
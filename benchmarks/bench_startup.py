@@ -0,0 +1,103 @@
+"""Measure cold start: time to import main and serve the first request.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--budget-ms MS] [--update-budget]
+                                          [--importtime]
+
+Each run is a fresh interpreter, like an App Engine instance starting from
+zero. The first request is GET /, which does not touch Datastore. To compare
+before and after a change, run the script on both checkouts. Without
+credentials, set DATASTORE_EMULATOR_HOST and DATASTORE_PROJECT_ID so that
+client creation does not fail.
+
+The median time to the first response is compared with the budget in
+benchmarks/startup_budget.json, and the script exits non-zero if it is
+over, so it can gate a CI job. --budget-ms overrides the recorded budget
+for one run. Timings depend on the machine, so after an intentional change
+or on new CI hardware run with --update-budget, which records the median
+plus BUDGET_HEADROOM to absorb noise. --importtime lists the modules that
+take longest to import.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+
+# Recorded budgets allow this much over the measured median
+BUDGET_HEADROOM = 1.5
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.app.test_client().get("/")
+served = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_request": served - imported,
+                  "total": served - start}))
+"""
+
+
+def run_once():
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def import_breakdown(top):
+    # python -X importtime reports cumulative microseconds per module
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                         check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    rows.sort(reverse=True)
+    for cumulative, name in rows[:top]:
+        print("%8.1f ms  %s" % (cumulative / 1000, name))
+
+
+def check_budget(total, budget_ms, update):
+    if update:
+        with open(BUDGET_FILE, "w") as f:
+            json.dump({"total_ms": round(total * BUDGET_HEADROOM)}, f, indent=4)
+            f.write("\n")
+        print("Recorded a %d ms startup budget in %s" % (round(total * BUDGET_HEADROOM), BUDGET_FILE))
+        return 0
+    if budget_ms is None:
+        with open(BUDGET_FILE) as f:
+            budget_ms = json.load(f)["total_ms"]
+    if total > budget_ms:
+        print("FAIL: time to first response %.1f ms is over the %.1f ms budget" % (total, budget_ms))
+        return 1
+    print("OK: time to first response %.1f ms is within the %.1f ms budget" % (total, budget_ms))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="budget to use instead of the recorded one")
+    parser.add_argument("--update-budget", action="store_true", help="record the current median as the budget")
+    parser.add_argument("--importtime", action="store_true", help="show the slowest imports")
+    args = parser.parse_args()
+
+    samples = [run_once() for _ in range(args.runs)]
+    for field in ("import", "first_request", "total"):
+        values = [sample[field] * 1000 for sample in samples]
+        print("%-14s median %8.1f ms   min %8.1f ms" % (field, statistics.median(values), min(values)))
+    if args.importtime:
+        import_breakdown(20)
+
+    total = statistics.median(sample["total"] for sample in samples) * 1000
+    return check_budget(total, args.budget_ms, args.update_budget)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
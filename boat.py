@@ -1,12 +1,11 @@
-from flask import Blueprint, request, make_response
-from google.cloud import datastore
+from flask import Blueprint, request, make_response, Response, stream_with_context
 import constants
-import json
+from db import client, new_entity
 from API_errors import *
 from jwt import verify_jwt
-from utils import APIError, get_user_from_sub, validate_content_type, authorize_boat_owner, get_load, get_boat, create_boat_repr
-
-client = datastore.Client()
+from counters import add_owner_stats, new_shard, owner_stats, random_shard_key
+from cache import page_cache
+from utils import APIError, dumps, counted_volume, update_user_boats, validate_content_type, authorize_boat_owner, get_boat, create_boat_repr, create_boat_reprs, boat_related, make_etag, not_modified, touch, link_load, unlink_load, update_boat, boat_volume, get_fields, get_expand, list_params, apply_list_query, project_query, export_ndjson, fetch_page, page_url, run_in_transaction, get_batch_content, allocate_keys, put_multi, invalidate, invalidate_owner
 
 bp = Blueprint('boat', __name__, url_prefix='/boats')
 
@@ -21,74 +20,172 @@ def boats_get_post():
         # Save request info in variable
         content = request.get_json()
         # Create new boat entity object
-        new_boat = datastore.entity.Entity(key=client.key(constants.boats))
+        new_boat = new_entity(client.key(constants.boats))
         new_boat.update({
             "name": content["name"], 
             "length": content["length"],
             "date_built": content["date_built"],
             "owner": payload["sub"],
-            "loads": []
+            "loads": [],
+            "load_summaries": [],
+            "load_volume": 0
             })
+        touch(new_boat)
         
         # Add new boat to Google Cloud Store
         client.put(new_boat)
 
         # Update user entity
-        query = client.query(kind=constants.users)
-        query.add_filter("sub", "=", payload["sub"])
-        user = list(query.fetch(limit=1))[0]
-        user["boats"].append(new_boat.key.id)
-        client.put(user)
+        update_user_boats(payload["sub"], add=[new_boat.key.id], name=payload.get("name"))
+        invalidate_owner(payload["sub"])
 
         # Return the new boat attributes
-        data = {
-            "id": new_boat.key.id,
-            "name": new_boat["name"],
-            "length": new_boat["length"],
-            "date_built": new_boat["date_built"],
-            "owner": new_boat["owner"],
-            "loads": [],
-            "self": request.base_url + '/' + str(new_boat.key.id)
-        }
-        res = make_response(json.dumps(data))
+        res = make_response(dumps(create_boat_repr(new_boat)))
         res.mimetype = constants.application_json
         res.status_code = 201
         return res
 
     elif request.method == 'GET':
         validate_content_type(request)
+        fields = get_fields(request, constants.boat_fields)
+        expand = get_expand(request, constants.boat_expand)
         query = client.query(kind=constants.boats)
         query.add_filter("owner", "=", payload["sub"])
+        filtered = apply_list_query(request, query, fixed=("owner",))
+        # Read only the properties the response needs; owner is known from the
+        # filter. Projections need their own indexes, so not when filtered.
+        partial = not filtered and project_query(query, fields, ("name", "length", "date_built", "loads"))
         
         # Apply pagination to results
-        q_limit = int(request.args.get('limit', '5'))  # default number of results is 3
+        q_limit = int(request.args.get('limit', '5'))  # default number of results is 5
         q_offset = int(request.args.get('offset', '0'))  # default offset is 0
-        b_iterator = query.fetch(limit=q_limit, offset=q_offset)
-        pages = b_iterator.pages
-        results = list(next(pages))
-        # Calculate url of next page if more results exist
-        if b_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+        q_cursor = request.args.get('cursor')  # cursor from a previous page's next link
+
+        # Pages of the owner's fleet are cached until one of their boats or loads changes
+        cached, generation = page_cache.get(payload["sub"], request.url)
+        if cached:
+            etag, body = cached
+            not_modified_res = not_modified(request, etag)
+            if not_modified_res:
+                return not_modified_res
         else:
-            next_url = None
-        
-        # Create list of boat representations
-        rep_results = []
-        for boat in results:
-            rep_results.append(create_boat_repr(boat))
-                
-        data = {"boats": rep_results}
-        # Add url of next page to output
-        if next_url:
-            data["next"] = next_url
-        res = make_response(json.dumps(data))
+            results, next_cursor = fetch_page(query, q_limit, q_cursor, 0 if q_cursor else q_offset)
+            # Calculate url of next page if more results exist
+            if next_cursor:
+                next_url = page_url(request.base_url, limit=q_limit, cursor=next_cursor, **list_params(request))
+            else:
+                next_url = None
+            if partial:
+                for boat in results:
+                    boat["owner"] = payload["sub"]
+
+            # Answer a poll for an unchanged page without building it
+            related = boat_related(results, fields, expand)
+            etag = make_etag(results, fields, expand, related, next_url)
+            not_modified_res = not_modified(request, etag)
+            if not_modified_res:
+                return not_modified_res
+
+            # Create list of boat representations
+            rep_results = create_boat_reprs(results, fields, expand, related)
+
+            data = {"boats": rep_results}
+            # Add url of next page to output
+            if next_url:
+                data["next"] = next_url
+            body = dumps(data)
+            page_cache.set(payload["sub"], request.url, generation, (etag, body))
+        res = make_response(body)
         res.mimetype = constants.application_json
         res.status_code = 200
+        res.set_etag(etag)
         return res
     else:
         raise APIError(ERR_405_NO_METHOD)
 
+@bp.route('/export', methods=['GET'])
+def boats_export():
+    # Authenticate owner
+    payload = verify_jwt(request)
+    fields = get_fields(request, constants.boat_fields)
+    expand = get_expand(request, constants.boat_expand)
+    query = client.query(kind=constants.boats)
+    query.add_filter("owner", "=", payload["sub"])
+    filtered = apply_list_query(request, query, fixed=("owner",))
+    partial = not filtered and project_query(query, fields, ("name", "length", "date_built", "loads"))
+
+    def represent(boats):
+        if partial:
+            for boat in boats:
+                boat["owner"] = payload["sub"]
+        return create_boat_reprs(boats, fields, expand)
+
+    # Stream every boat of the owner as one JSON object per line
+    res = Response(stream_with_context(export_ndjson(query, represent)))
+    res.mimetype = constants.application_ndjson
+    res.status_code = 200
+    return res
+
+@bp.route('/stats', methods=['GET'])
+def boats_stats():
+    # Authenticate owner
+    payload = verify_jwt(request)
+
+    # Totals for the owner's whole fleet, read from counters
+    stats = owner_stats(client, payload["sub"])
+    data = {
+        "owner": payload["sub"],
+        "boats": stats["boats"],
+        "loads": stats["loads"],
+        "volume": stats["volume"],
+        "self": request.base_url
+    }
+    res = make_response(dumps(data))
+    res.mimetype = constants.application_json
+    res.status_code = 200
+    return res
+
+@bp.route('/batch', methods=['POST'])
+def boats_post_batch():
+    # Authenticate owner
+    payload = verify_jwt(request)
+    content = get_batch_content(request)
+
+    # Create new boat entity objects, rejecting the batch if any is invalid
+    keys = allocate_keys(constants.boats, len(content))
+    new_boats = []
+    for key, item in zip(keys, content):
+        new_boat = new_entity(key)
+        try:
+            new_boat.update({
+                "name": item["name"],
+                "length": item["length"],
+                "date_built": item["date_built"],
+                "owner": payload["sub"],
+                "loads": [],
+                "load_summaries": [],
+                "load_volume": 0
+                })
+        except KeyError:
+            raise APIError(ERR_400_INVALID_ATTR)
+        touch(new_boat)
+        new_boats.append(new_boat)
+
+    # Add new boats to Google Cloud Store
+    put_multi(new_boats)
+
+    # Update user entity once for the whole batch
+    update_user_boats(payload["sub"], add=[new_boat.key.id for new_boat in new_boats],
+                      name=payload.get("name"))
+    invalidate_owner(payload["sub"])
+
+    # Return the new boat attributes
+    data = {"boats": create_boat_reprs(new_boats)}
+    res = make_response(dumps(data))
+    res.mimetype = constants.application_json
+    res.status_code = 201
+    return res
+
 @bp.route('/<id>', methods=['DELETE','GET', 'PUT', 'PATCH'])
 def boats_get_put_patch_delete(id):
     # Authenticate owner
@@ -104,49 +201,48 @@ def boats_get_put_patch_delete(id):
     authorize_boat_owner(payload, boat)
 
     if request.method == 'DELETE':
-        # Update the carrier attribute of all loads on this boat
-        for item in boat["loads"]:
-            load_key, load = get_load(item)
-            load["carrier"] = None
-            client.put(load)
+        # Unload the boat and delete it
+        clear_boat(boat_key, boat["owner"])
 
         # Update the boats attribute of the owner's user entity
-        user = get_user_from_sub(payload["sub"])
-        boat_to_delete = [item for item in user["boats"] if item == boat.key.id][0]
-        user["boats"].remove(boat_to_delete)
-        client.put(user)
-
-        # Delete the boat
-        client.delete(boat_key)
+        update_user_boats(payload["sub"], remove=[boat.key.id])
+        invalidate_owner(payload["sub"])
         return '', 204
     elif request.method == 'GET':
         validate_content_type(request)
-        boat = create_boat_repr(boat)
-        res = make_response(json.dumps(boat))
+        fields = get_fields(request, constants.boat_fields)
+        expand = get_expand(request, constants.boat_expand)
+        related = boat_related([boat], fields, expand)
+        etag = make_etag([boat], fields, expand, related)
+        not_modified_res = not_modified(request, etag)
+        if not_modified_res:
+            return not_modified_res
+        boat = create_boat_repr(boat, fields, expand, related)
+        res = make_response(dumps(boat))
         res.status_code = 200
         res.mimetype = constants.application_json
+        res.set_etag(etag)
         return res
     elif request.method == 'PUT':
         validate_content_type(request)
         
         # Replace boat entity content
         content = request.get_json()
-        boat["name"] = content["name"]
-        boat["date_built"] = content["date_built"]
-        boat["length"] = content["length"]
-
-        # Remove boat to load relationships
-        for load in boat["loads"]:
-            delete_load(boat.key.id, load)
-
-        boat["loads"] = []
+        replacement = {
+            "name": content["name"],
+            "date_built": content["date_built"],
+            "length": content["length"],
+            "load_summaries": [],
+            "load_volume": 0
+        }
 
-        # Update boat
-        client.put(boat)
+        # Remove boat to load relationships, then replace the boat
+        boat = clear_boat(boat_key, boat["owner"], replacement)
+        invalidate_owner(payload["sub"])
         
         # Return the boat object
         boat = create_boat_repr(boat)
-        res = make_response(json.dumps(boat))
+        res = make_response(dumps(boat))
         res.mimetype = constants.application_json
         res.status_code = 200
         return res
@@ -154,67 +250,220 @@ def boats_get_put_patch_delete(id):
         validate_content_type(request)
         
         content = request.get_json()
-        for attr in content:
-            if attr != "loads":
-                boat[attr] = content[attr]
-
-        client.put(boat)
+        # A boat keeps its owner, whose user entity and totals count it
+        updates = {attr: content[attr] for attr in content
+                   if attr not in ("loads", "owner") and attr not in constants.unindexed}
+        # A new name is copied onto the loads on the boat
+        if updates or 'loads' not in content:
+            update_boat(boat.key.id, updates)
+            invalidate_owner(payload["sub"])
+        if 'loads' not in content:
+            return '', 204
 
         # Add any new loads
-        if 'loads' in content:
-            for load in content["loads"]:
-                try:
-                    add_load(boat.key.id, load)
-                    boat["loads"].append(load)
-                except(APIError):
-                    print("Load already on boat")
-
-        return '', 204
+        attached, rejected = attach_loads(boat.key.id, content["loads"], boat["owner"])
+        if attached:
+            invalidate_owner(payload["sub"])
+        data = {"attached": attached, "rejected": rejected}
+        res = make_response(dumps(data))
+        res.mimetype = constants.application_json
+        res.status_code = 200
+        return res
     else:
         raise APIError(ERR_405_NO_METHOD)
 
+@bp.route('/<id>/stats', methods=['GET'])
+def boat_stats(id):
+    # Authenticate owner
+    payload = verify_jwt(request)
+
+    boat_key, boat = get_boat(id)
+    if not boat:
+        raise APIError(ERR_404_INVALID_ID)
+    authorize_boat_owner(payload, boat)
+
+    data = {
+        "id": boat.key.id,
+        "loads": len(boat["loads"]),
+        "volume": boat_volume(boat),
+        "self": request.base_url
+    }
+    res = make_response(dumps(data))
+    res.mimetype = constants.application_json
+    res.status_code = 200
+    return res
+
+def get_boat_and_load(boat_id, load_id, owner):
+    """Fetch a boat, a load and one of owner's stats shards with a single lookup"""
+    boat_key = client.key(constants.boats, int(boat_id))
+    load_key = client.key(constants.loads, int(load_id))
+    shard_key = random_shard_key(client, owner)
+    found = {entity.key.kind: entity for entity in client.get_multi([boat_key, load_key, shard_key])}
+    shard = found.get(constants.owner_stats) or new_shard(shard_key, owner)
+    return found.get(constants.boats), found.get(constants.loads), shard
+
+def clear_boat(boat_key, owner, replacement=None):
+    """Take every load off a boat belonging to owner, then delete it or apply replacement.
+
+    Each transaction reads the boat and the next chunk of its loads again,
+    clears their carriers, and writes them with the boat and one of the
+    owner's stats shards, so the totals move in the same commit as the
+    loads. The last transaction also deletes or replaces the boat. A boat
+    carrying more loads than one commit allows is unloaded over several
+    transactions; if one fails, the boat still lists the loads it carries.
+    Returns the boat as written, or None once deleted.
+    """
+    # Leave room in each commit for the boat and the stats shard
+    chunk_size = constants.max_mutations - 2
+
+    def clear():
+        shard_key = random_shard_key(client, owner)
+        found = {entity.key: entity for entity in client.get_multi([boat_key, shard_key])}
+        boat = found.get(boat_key)
+        if not boat:
+            raise APIError(ERR_404_INVALID_ID)
+        chunk = boat["loads"][:chunk_size]
+        cleared = []
+        for load in client.get_multi([client.key(constants.loads, load_id) for load_id in chunk]):
+            # Ids of loads that are gone or carried elsewhere are dropped too
+            if load["carrier"] == boat_key.id:
+                load["carrier"] = None
+                load["carrier_name"] = None
+                cleared.append(load)
+        removed = set(chunk)
+        boat["loads"] = boat["loads"][len(chunk):]
+        if "load_summaries" in boat:
+            boat["load_summaries"] = [summary for summary in boat["load_summaries"] if summary["id"] not in removed]
+        volume = sum(counted_volume(load) for load in cleared)
+        if "load_volume" in boat:
+            boat["load_volume"] -= volume
+        add_owner_stats(client, owner, -len(cleared), -volume,
+                        found.get(shard_key) or new_shard(shard_key, owner))
+        done = not boat["loads"]
+        if done and replacement is None:
+            client.delete(boat_key)
+            boat = None
+        else:
+            if done:
+                boat.update(replacement)
+            touch(boat)
+            client.put(boat)
+        touch(*cleared)
+        client.put_multi(cleared)
+        return boat, cleared, done
+
+    done = False
+    while not done:
+        boat, cleared, done = run_in_transaction(client, clear)
+        invalidate(boat_key, *cleared)
+    return boat
+
+def attach_loads(boat_id, load_ids, owner):
+    """Attach many loads to a boat belonging to owner.
+
+    All loads are read with one lookup and written with the boat and one
+    of the owner's stats shards in one transaction. Requests larger than a
+    single commit allows are split into several transactions. Returns the attached load ids and a list
+    of rejected ids with the reason.
+    """
+    attached = []
+    rejected = []
+    ids = []
+    for load_id in load_ids:
+        try:
+            ids.append(int(load_id))
+        except (TypeError, ValueError):
+            rejected.append({"id": load_id, "Error": ERR_400_INVALID_ATTR["description"]})
+    ids = list(dict.fromkeys(ids))
+
+    boat_key = client.key(constants.boats, int(boat_id))
+    # Leave room in each commit for the boat and the stats shard
+    chunk_size = constants.max_mutations - 2
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    for chunk in chunks:
+        def attach():
+            shard_key = random_shard_key(client, owner)
+            keys = [boat_key, shard_key] + [client.key(constants.loads, load_id) for load_id in chunk]
+            found = {entity.key: entity for entity in client.get_multi(keys)}
+            boat = found.get(boat_key)
+            if not boat:
+                raise APIError(ERR_404_INVALID_ID)
+            changed = [boat]
+            ok = []
+            failed = []
+            for load_id in chunk:
+                load = found.get(client.key(constants.loads, load_id))
+                if not load:
+                    failed.append({"id": load_id, "Error": ERR_404_INVALID_ID["description"]})
+                elif load["carrier"]:
+                    failed.append({"id": load_id, "Error": ERR_403_LOAD["description"]})
+                else:
+                    link_load(boat, load)
+                    changed.append(load)
+                    ok.append(load_id)
+            add_owner_stats(client, owner, len(ok), sum(counted_volume(load) for load in changed[1:]),
+                            found.get(shard_key) or new_shard(shard_key, owner))
+            touch(*changed)
+            client.put_multi(changed)
+            return ok, failed
+
+        ok, failed = run_in_transaction(client, attach)
+        invalidate(boat_key, *[client.key(constants.loads, load_id) for load_id in ok])
+        attached.extend(ok)
+        rejected.extend(failed)
+    return attached, rejected
+
 @bp.route('/<boat_id>/loads/<load_id>', methods=['PUT'])
 def add_load(boat_id,load_id):
     # Authenticate owner
     payload = verify_jwt(request)
-    boat_key, boat = get_boat(boat_id)
-    authorize_boat_owner(payload, boat)
-    load_key, load = get_load(load_id)
-    
-    # Check if the boat and/or load exists
-    if not boat or not load:
-        raise APIError(ERR_404_INVALID_ID)
-    # Check if load is on another boat
-    if load["carrier"]:
-        raise APIError(ERR_403_LOAD)
-    # Add boat to load
-    load["carrier"] = int(boat_id)
-    # Add load to boat
-    boat["loads"].append(int(load_id))
-    # Update both boat and load
-    client.put(load)
-    client.put(boat)
+
+    def attach():
+        boat, load, shard = get_boat_and_load(boat_id, load_id, payload["sub"])
+        # Check if the boat and/or load exists
+        if not boat or not load:
+            raise APIError(ERR_404_INVALID_ID)
+        authorize_boat_owner(payload, boat)
+        # Check if load is on another boat
+        if load["carrier"]:
+            raise APIError(ERR_403_LOAD)
+        # Add boat to load and load to boat
+        link_load(boat, load)
+        add_owner_stats(client, boat["owner"], 1, counted_volume(load), shard)
+        # Update both boat and load
+        touch(boat, load)
+        client.put_multi([boat, load])
+
+    # The carrier check and both writes commit atomically
+    run_in_transaction(client, attach)
+    invalidate(client.key(constants.boats, int(boat_id)), client.key(constants.loads, int(load_id)))
+    invalidate_owner(payload["sub"])
     return '', 204
 
 @bp.route('/<boat_id>/loads/<load_id>', methods=['DELETE'])
 def delete_load(boat_id,load_id):
     # Authenticate owner
     payload = verify_jwt(request)
-    boat_key, boat = get_boat(boat_id)
-    authorize_boat_owner(payload, boat)
-    load_key, load = get_load(load_id)
-    
-    # Check if the boat and/or load exists
-    if not boat or not load:
-        raise APIError(ERR_404_INVALID_ID)
-    for item in boat["loads"]:
-        if item == int(load_id):
-            # Remove load from boat
-            boat["loads"].remove(item)
-            client.put(boat)
-            # Update load carrier
-            load["carrier"] = None
-            client.put(load)
-            return '', 204
-    # Return 404 if the load was not found on the boat
-    raise APIError(ERR_404_INVALID_ID)
\ No newline at end of file
+
+    def detach():
+        boat, load, shard = get_boat_and_load(boat_id, load_id, payload["sub"])
+        # Check if the boat and/or load exists
+        if not boat or not load:
+            raise APIError(ERR_404_INVALID_ID)
+        authorize_boat_owner(payload, boat)
+        # Return 404 if the load was not found on the boat
+        if int(load_id) not in boat["loads"]:
+            raise APIError(ERR_404_INVALID_ID)
+        # Remove load from boat
+        unlink_load(boat, load)
+        add_owner_stats(client, boat["owner"], -1, -counted_volume(load), shard)
+        # Update load carrier
+        load["carrier"] = None
+        load["carrier_name"] = None
+        touch(boat, load)
+        client.put_multi([boat, load])
+
+    run_in_transaction(client, detach)
+    invalidate(client.key(constants.boats, int(boat_id)), client.key(constants.loads, int(load_id)))
+    invalidate_owner(payload["sub"])
+    return '', 204
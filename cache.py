@@ -0,0 +1,271 @@
+from copy import deepcopy
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from os import environ as env
+
+# Entity cache settings
+ENTITY_CACHE_SIZE = int(env.get("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = float(env.get("ENTITY_CACHE_TTL", "30"))
+ENTITY_CACHE_URL = env.get("ENTITY_CACHE_URL")  # e.g. redis://10.0.0.3:6379/0
+# With a shared backend, how long an instance keeps its own copy; another
+# instance's write is only seen once it expires. 0 reads Redis every time.
+ENTITY_CACHE_LOCAL_TTL = float(env.get("ENTITY_CACHE_LOCAL_TTL", "1"))
+
+# List page cache settings; pages are shared through Redis when a URL is set
+PAGE_CACHE_SIZE = int(env.get("PAGE_CACHE_SIZE", "1000"))
+PAGE_CACHE_TTL = float(env.get("PAGE_CACHE_TTL", "30"))
+PAGE_CACHE_URL = env.get("PAGE_CACHE_URL", ENTITY_CACHE_URL)
+
+# Keys deleted per command when a Redis cache is cleared
+CLEAR_BATCH_SIZE = 500
+
+class LRUCache:
+    """In-process LRU with a size bound and a per-entry TTL"""
+    def __init__(self, maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_multi(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.counters["misses"] += 1
+                    continue
+                expires, value = entry
+                if now >= expires:
+                    del self._entries[key]
+                    self.counters["misses"] += 1
+                    self.counters["evictions"] += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                found[key] = value
+        return found
+
+    def set_multi(self, items):
+        if not self.maxsize:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(self.counters, size=len(self._entries))
+
+class RedisCache:
+    """Cache backend in Redis, shared by every instance that uses the same URL.
+
+    A write deletes the key here, so instances that read through this
+    backend see it at once; copies they keep in process are not reached.
+    Needs the redis package, which is only imported when a URL is configured.
+    """
+    def __init__(self, url, ttl=ENTITY_CACHE_TTL, prefix="entity:"):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.counters = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _name(self, key):
+        return self.prefix + "%s:%s" % key
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = self._redis.mget([self._name(key) for key in keys])
+        except Exception:
+            # A cache outage must not take the API down
+            self.counters["errors"] += 1
+            return {}
+        found = {}
+        for key, value in zip(keys, values):
+            if value is None:
+                self.counters["misses"] += 1
+            else:
+                self.counters["hits"] += 1
+                found[key] = pickle.loads(value)
+        return found
+
+    def set_multi(self, items):
+        try:
+            pipe = self._redis.pipeline()
+            for key, value in items.items():
+                pipe.set(self._name(key), pickle.dumps(value), px=int(self.ttl * 1000))
+            pipe.execute()
+        except Exception:
+            self.counters["errors"] += 1
+
+    def delete_multi(self, keys):
+        keys = [self._name(key) for key in keys]
+        if not keys:
+            return
+        try:
+            self._redis.delete(*keys)
+        except Exception:
+            self.counters["errors"] += 1
+
+    def clear(self):
+        """Delete every key under this cache's prefix, a batch at a time"""
+        try:
+            batch = []
+            for name in self._redis.scan_iter(match=self.prefix + "*", count=CLEAR_BATCH_SIZE):
+                batch.append(name)
+                if len(batch) == CLEAR_BATCH_SIZE:
+                    self._redis.delete(*batch)
+                    batch = []
+            if batch:
+                self._redis.delete(*batch)
+        except Exception:
+            self.counters["errors"] += 1
+
+    def stats(self):
+        return dict(self.counters)
+
+class EntityCache:
+    """Read-through cache of Datastore entities keyed by (kind, id or name).
+
+    Entities are copied on the way in and out, because handlers modify the
+    entities they are given. Callers that only read them may pass
+    copy=False to get_multi and must then leave them unchanged.
+
+    The local tier is checked first. An invalidation only clears this
+    process's local tier and the shared one, so with a shared backend the
+    local tier should have a short TTL, or be None to always read it.
+    """
+    def __init__(self, local=None, shared=None):
+        # Without a shared backend there has to be a local one
+        self.local = local if local is not None or shared is not None else LRUCache()
+        self.shared = shared
+
+    def get_multi(self, keys, copy=True):
+        found = self.local.get_multi(keys) if self.local is not None else {}
+        if self.shared is not None:
+            missing = [key for key in keys if key not in found]
+            if missing:
+                remote = self.shared.get_multi(missing)
+                if self.local is not None:
+                    self.local.set_multi(remote)
+                found.update(remote)
+        if not copy:
+            return found
+        return {key: deepcopy(value) for key, value in found.items()}
+
+    def set_multi(self, entities):
+        items = {(entity.key.kind, entity.key.id_or_name): deepcopy(entity) for entity in entities}
+        if self.local is not None:
+            self.local.set_multi(items)
+        if self.shared is not None:
+            self.shared.set_multi(items)
+
+    def invalidate(self, keys):
+        keys = list(keys)
+        if self.local is not None:
+            self.local.delete_multi(keys)
+        if self.shared is not None:
+            self.shared.delete_multi(keys)
+
+    def clear(self):
+        if self.local is not None:
+            self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        data = {}
+        if self.local is not None:
+            data["local"] = self.local.stats()
+        if self.shared is not None:
+            data["shared"] = self.shared.stats()
+        return data
+
+def create_entity_cache():
+    if not ENTITY_CACHE_URL:
+        return EntityCache()
+    local = LRUCache(ttl=ENTITY_CACHE_LOCAL_TTL) if ENTITY_CACHE_LOCAL_TTL > 0 else None
+    return EntityCache(local=local, shared=RedisCache(ENTITY_CACHE_URL))
+
+entity_cache = create_entity_cache()
+
+class PageCache:
+    """Rendered list pages, grouped by owner.
+
+    Every owner has a generation and a page is only served if it was stored
+    under the owner's current one. bump() gives the owner a new generation,
+    which retires all of their pages at once without looking for them. A
+    page is read together with its owner's generation in one get_multi, so
+    a hit costs a single cache lookup.
+
+    Generations are the time in nanoseconds when they were made, so a
+    generation that was evicted or expired is never recreated with an old
+    value. The backend is an LRUCache, or a RedisCache to share pages and
+    bumps between instances.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.counters = {"hits": 0, "misses": 0, "bumps": 0}
+
+    def _keys(self, owner, page):
+        return ("generation", owner), ("page", "%s|%s" % (owner, page))
+
+    def _new_generation(self, owner):
+        generation = time.time_ns()
+        self.backend.set_multi({("generation", owner): generation})
+        return generation
+
+    def get(self, owner, page):
+        """Return the cached value of page, or None, and the generation to store it under"""
+        generation_key, page_key = self._keys(owner, page)
+        found = self.backend.get_multi([generation_key, page_key])
+        generation = found.get(generation_key)
+        if generation is None:
+            self.counters["misses"] += 1
+            return None, self._new_generation(owner)
+        entry = found.get(page_key)
+        if entry is None or entry[0] != generation:
+            self.counters["misses"] += 1
+            return None, generation
+        self.counters["hits"] += 1
+        return entry[1], generation
+
+    def set(self, owner, page, generation, value):
+        """Store a page built from reads made after get() returned generation"""
+        _, page_key = self._keys(owner, page)
+        self.backend.set_multi({page_key: (generation, value)})
+
+    def bump(self, owner):
+        """Retire every cached page of owner; call it after the write commits"""
+        self.counters["bumps"] += 1
+        self._new_generation(owner)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return dict(self.counters, backend=self.backend.stats())
+
+page_cache = PageCache(RedisCache(PAGE_CACHE_URL, ttl=PAGE_CACHE_TTL, prefix="page:") if PAGE_CACHE_URL
+                       else LRUCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL))
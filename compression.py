@@ -0,0 +1,145 @@
+"""Response compression negotiated from Accept-Encoding.
+
+JSON and NDJSON responses are compressed with brotli, when the Brotli
+package is installed and the client accepts it, or gzip. Bodies smaller
+than COMPRESS_MIN_SIZE are sent as they are. Streamed responses are
+compressed chunk by chunk and flushed after each one, so clients still
+receive every page as soon as it is produced.
+
+Bytes in and out and the CPU time spent compressing are reported by
+metrics.
+"""
+import time
+import zlib
+from os import environ as env
+
+from flask import request
+
+import constants
+from metrics import registry, span
+
+# Smallest body worth compressing, in bytes; streamed bodies are always compressed
+COMPRESS_MIN_SIZE = int(env.get("COMPRESS_MIN_SIZE", "1024"))
+# gzip level 1-9 and brotli quality 0-11; higher is smaller but costs more CPU
+GZIP_LEVEL = int(env.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(env.get("BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE = (constants.application_json, constants.application_ndjson)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class GzipCompressor:
+    def __init__(self, level=GZIP_LEVEL):
+        # wbits 31 writes a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class BrotliCompressor:
+    def __init__(self, quality=BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+def encodings():
+    """Content codings this server can produce, most preferred first"""
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+def new_compressor(encoding):
+    if encoding == "br":
+        return BrotliCompressor()
+    return GzipCompressor()
+
+def choose_encoding(req):
+    """Return the best coding the client accepts, or None for identity"""
+    return req.accept_encodings.best_match(encodings())
+
+def compressible(response):
+    return (response.mimetype in COMPRESSIBLE
+            and 200 <= response.status_code < 300
+            and response.status_code != 204
+            and "Content-Encoding" not in response.headers
+            and not response.direct_passthrough)
+
+def weaken_etag(response):
+    # A compressed body is not byte-for-byte the same as the uncompressed
+    # one, so its validator can only be weak; If-None-Match compares weakly
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+def compress_body(response, encoding):
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        registry.observe_compression("identity", len(data), len(data), 0.0)
+        return
+    with span("compress"):
+        start = time.thread_time()
+        compressor = new_compressor(encoding)
+        body = compressor.compress(data) + compressor.finish()
+        registry.observe_compression(encoding, len(data), len(body), time.thread_time() - start)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    weaken_etag(response)
+
+def compress_stream(chunks, encoding):
+    compressor = new_compressor(encoding)
+    raw = compressed = 0
+    seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            start = time.thread_time()
+            body = compressor.compress(chunk)
+            seconds += time.thread_time() - start
+            raw += len(chunk)
+            compressed += len(body)
+            if body:
+                yield body
+        start = time.thread_time()
+        body = compressor.finish()
+        seconds += time.thread_time() - start
+        compressed += len(body)
+        yield body
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        registry.observe_compression(encoding, raw, compressed, seconds)
+
+def compress_response(req, response):
+    """Compress response in place for req's Accept-Encoding, if it is worth it"""
+    if not compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(req)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+        weaken_etag(response)
+    else:
+        compress_body(response, encoding)
+    return response
+
+def init_app(app):
+    """Compress the responses of app. Register it after metrics.init_app, so
+    that compression is timed as part of the request."""
+    @app.after_request
+    def compress(response):
+        return compress_response(request, response)
@@ -2,6 +2,22 @@
 boats = "boats"
 loads = "loads"
 users = "users"
+owner_stats = "owner_stats"
+
+# representation attributes, for ?fields= and ?expand=
+boat_fields = ("id", "name", "length", "date_built", "owner", "loads", "self")
+boat_expand = ("loads",)
+load_fields = ("id", "volume", "carrier", "item", "creation_date", "self")
+load_expand = ("carrier",)
+
+# properties never used in queries, so they skip index writes
+unindexed = ("version", "load_summaries", "carrier_name", "load_volume")
+
+# datastore limits
+max_lookup_keys = 1000  # keys per lookup RPC
+max_mutations = 500  # entities per commit RPC
+transaction_retries = 5  # retries after a contention abort
 
 # generic constants
-application_json = 'application/json'
\ No newline at end of file
+application_json = 'application/json'
+application_ndjson = 'application/x-ndjson'
\ No newline at end of file
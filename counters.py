@@ -0,0 +1,69 @@
+"""Owner totals kept up to date by every write that changes them.
+
+An owner's load count and load volume are spread over OWNER_STATS_SHARDS
+entities of kind owner_stats, keyed "<sub>:<shard>", so that concurrent
+writes for one busy owner rarely contend for the same entity. A writer
+adds to one shard chosen at random, inside the transaction that moves
+the loads; a reader sums every shard with one lookup. The owner's boat
+count is the length of the boats list on their user entity.
+
+reconcile_stats.py rebuilds the totals from the boats if they drift.
+"""
+import random
+from os import environ as env
+
+import constants
+from db import new_entity
+from utils import run_in_transaction
+
+# More shards allow more concurrent writes for one owner; only ever raise it
+OWNER_STATS_SHARDS = int(env.get("OWNER_STATS_SHARDS", "4"))
+
+def shard_key(ds_client, sub, shard):
+    return ds_client.key(constants.owner_stats, "%s:%d" % (sub, shard))
+
+def shard_keys(ds_client, sub):
+    return [shard_key(ds_client, sub, shard) for shard in range(OWNER_STATS_SHARDS)]
+
+def new_shard(key, sub):
+    shard = new_entity(key)
+    shard.update({"owner": sub, "loads": 0, "volume": 0})
+    # Only ever read by key
+    shard.exclude_from_indexes = {"loads", "volume"}
+    return shard
+
+def random_shard_key(ds_client, sub):
+    return shard_key(ds_client, sub, random.randrange(OWNER_STATS_SHARDS))
+
+def add_owner_stats(ds_client, sub, loads=0, volume=0, shard=None):
+    """Add to an owner's totals.
+
+    Call it inside the transaction that changes the loads, so both commit
+    together; outside one it runs in a transaction of its own. A caller
+    can save a lookup by adding random_shard_key() to its own lookup and
+    passing the shard it found.
+    """
+    if not loads and not volume:
+        return
+    if ds_client.current_transaction is None:
+        run_in_transaction(ds_client, lambda: add_owner_stats(ds_client, sub, loads, volume, shard))
+        return
+    if shard is None:
+        key = random_shard_key(ds_client, sub)
+        shard = ds_client.get(key) or new_shard(key, sub)
+    shard["loads"] += loads
+    shard["volume"] += volume
+    ds_client.put(shard)
+
+def owner_stats(ds_client, sub):
+    """Return an owner's boat count, load count and load volume with one lookup"""
+    user_key = ds_client.key(constants.users, sub)
+    found = ds_client.get_multi([user_key] + shard_keys(ds_client, sub))
+    stats = {"boats": 0, "loads": 0, "volume": 0}
+    for entity in found:
+        if entity.key == user_key:
+            stats["boats"] = len(entity["boats"])
+        else:
+            stats["loads"] += entity["loads"]
+            stats["volume"] += entity["volume"]
+    return stats
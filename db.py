@@ -0,0 +1,101 @@
+import threading
+from os import environ as env
+
+from flask import current_app, has_app_context
+from werkzeug.local import LocalProxy
+
+from metrics import traced_client
+
+# Storage backend: "datastore", or "memory" for the in-process stand-in
+STORAGE_BACKEND = env.get("STORAGE_BACKEND", "datastore")
+MEMORY_RPC_LATENCY = float(env.get("MEMORY_RPC_LATENCY", "0"))
+
+# Datastore transport settings
+DATASTORE_TRANSPORT = env.get("DATASTORE_TRANSPORT")  # "grpc" or "http", library default if unset
+DATASTORE_HTTP_POOL_SIZE = int(env.get("DATASTORE_HTTP_POOL_SIZE", "10"))
+DATASTORE_GRPC_KEEPALIVE_MS = int(env.get("DATASTORE_GRPC_KEEPALIVE_MS", "30000"))
+
+_client = None
+_lock = threading.Lock()
+
+def create_client():
+    """Build the storage client for the configured backend and transport"""
+    if STORAGE_BACKEND == "memory":
+        from storage import MemoryClient
+        return MemoryClient(rpc_latency=MEMORY_RPC_LATENCY)
+
+    # Imported here so importing the app does not pay for the client library
+    from google.cloud import datastore
+
+    if DATASTORE_TRANSPORT == "http":
+        return datastore.Client(_http=_http_session(datastore.Client.SCOPE), _use_grpc=False)
+
+    ds_client = datastore.Client(_use_grpc=True if DATASTORE_TRANSPORT == "grpc" else None)
+    if ds_client._use_grpc and not env.get("DATASTORE_EMULATOR_HOST"):
+        ds_client._datastore_api_internal = _grpc_api(ds_client)
+    return ds_client
+
+def _http_session(scopes):
+    # One pooled session shared by every worker thread
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+    credentials, _ = google.auth.default(scopes=scopes)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=DATASTORE_HTTP_POOL_SIZE,
+                          pool_maxsize=DATASTORE_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+def _grpc_api(ds_client):
+    # Same as the library's default channel, plus keepalives so idle
+    # instances do not have to reconnect on the next request
+    from urllib.parse import urlparse
+    from google.cloud._helpers import make_secure_channel
+    from google.cloud._http import DEFAULT_USER_AGENT
+    from google.cloud.datastore_v1.services.datastore import client as datastore_client
+    from google.cloud.datastore_v1.services.datastore.transports import grpc
+
+    host = urlparse(ds_client._base_url).netloc
+    options = (
+        ("grpc.keepalive_time_ms", DATASTORE_GRPC_KEEPALIVE_MS),
+        ("grpc.keepalive_permit_without_calls", 1),
+    )
+    channel = make_secure_channel(ds_client._credentials, DEFAULT_USER_AGENT, host,
+                                  extra_options=options)
+    transport = grpc.DatastoreGrpcTransport(channel=channel)
+    return datastore_client.DatastoreClient(transport=transport, client_info=ds_client._client_info)
+
+def new_entity(key):
+    """Create an entity for key; the client library is imported on first use"""
+    from google.cloud import datastore
+    return datastore.Entity(key=key)
+
+def get_client():
+    """Return the Datastore client for the current app, creating it on first use.
+
+    An app may supply its own client through init_app; otherwise every
+    caller in the process shares a single client.
+    """
+    global _client
+    if has_app_context():
+        app_client = current_app.extensions.get("datastore")
+        if app_client is not None:
+            return app_client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = create_client()
+    return _client
+
+def init_app(app, ds_client=None):
+    """Register a client on the app; None keeps the shared lazy client"""
+    app.extensions["datastore"] = ds_client
+
+def request_client():
+    """Return the client, wrapped to record its RPCs when the request is traced"""
+    return traced_client(get_client())
+
+# Module-level handle used by the blueprints; resolved on every access
+client = LocalProxy(request_client)
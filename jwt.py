@@ -1,8 +1,11 @@
+import hashlib
 import json
-from jose import jwt
+import threading
+import time
+from collections import OrderedDict
 from os import environ as env
-from urllib.request import urlopen
 from dotenv import find_dotenv, load_dotenv
+from metrics import span, timed
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
@@ -15,8 +18,215 @@ class AuthError(Exception):
 
 ALGORITHMS = ["RS256"]
 
+# JWKS cache settings (seconds)
+JWKS_TTL = int(env.get("JWKS_TTL", "3600"))
+JWKS_STALE_TTL = int(env.get("JWKS_STALE_TTL", "300"))
+JWKS_MIN_REFRESH_INTERVAL = int(env.get("JWKS_MIN_REFRESH_INTERVAL", "30"))
+JWKS_FETCH_TIMEOUT = float(env.get("JWKS_FETCH_TIMEOUT", "5"))
+
+class JWKSCache:
+    """Process-wide store of the Auth0 signing keys, indexed by kid.
+
+    Keys are served from memory until the TTL runs out. For a further
+    stale_ttl seconds the old keys are still served while a background
+    thread refetches the document. An unknown kid triggers one refetch
+    that concurrent callers share, at most once per min_refresh_interval.
+    No fetch waits longer than fetch_timeout for Auth0, and after a failed
+    fetch no other is tried for min_refresh_interval.
+    """
+    def __init__(self, ttl=JWKS_TTL, stale_ttl=JWKS_STALE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, fetch_timeout=JWKS_FETCH_TIMEOUT):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch_timeout = fetch_timeout
+        self._keys = {}
+        self._fetched_at = None
+        # When the last fetch finished, whether or not it succeeded
+        self._attempted_at = None
+        # _lock only guards swapping in new keys; _fetch_lock makes callers
+        # that need keys now share one fetch; _refreshing_lock guards the
+        # flag that allows one background refresh at a time
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refreshing_lock = threading.Lock()
+        self._refreshing = False
+        self.counters = {"hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0}
+
+    def url(self):
+        return "https://" + env.get("AUTH0_DOMAIN") + "/.well-known/jwks.json"
+
+    def fetch(self):
+        from urllib.request import urlopen
+        with span("jwks"):
+            jsonurl = urlopen(self.url(), timeout=self.fetch_timeout)
+            return json.loads(jsonurl.read())
+
+    def get_key(self, kid):
+        """Return the decoded RSA key for kid, or None if Auth0 does not publish it"""
+        now = time.monotonic()
+        fetched_at = self._fetched_at
+        if fetched_at is None or now - fetched_at > self.ttl + self.stale_ttl:
+            # Nothing usable in memory, callers have to wait for the fetch
+            self._refresh(fetched_at)
+        elif now - fetched_at > self.ttl:
+            # Serve stale keys while the document is refetched
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self.counters["hits"] += 1
+            return key
+
+        self.counters["misses"] += 1
+        # Auth0 may have rotated its signing key since the last fetch
+        fetched_at = self._fetched_at
+        if fetched_at is None or now - fetched_at >= self.min_refresh_interval:
+            self._refresh(fetched_at)
+        return self._keys.get(kid)
+
+    def stats(self):
+        return dict(self.counters, keys=len(self._keys))
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._attempted_at = None
+
+    def _attempted_recently(self):
+        attempted_at = self._attempted_at
+        return attempted_at is not None and time.monotonic() - attempted_at < self.min_refresh_interval
+
+    def _refresh(self, seen_fetched_at):
+        with self._fetch_lock:
+            # Another thread refreshed while this one waited for the lock
+            if self._fetched_at != seen_fetched_at:
+                return
+            # Or tried and failed; wait out the interval instead of queueing
+            # up one fetch per request while Auth0 is down
+            if self._attempted_recently():
+                if not self._keys:
+                    raise jwks_unavailable()
+                return
+            self._load()
+
+    def _refresh_in_background(self):
+        if self._attempted_recently():
+            return
+        # Requests in the stale window never wait for the fetch itself
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self._load()
+        finally:
+            with self._refreshing_lock:
+                self._refreshing = False
+
+    def _load(self):
+        # Fetches without holding self._lock and swaps the new keys in at the end
+        from jose import jwk
+        try:
+            jwks = self.fetch()
+        except Exception:
+            self._attempted_at = time.monotonic()
+            self.counters["refresh_errors"] += 1
+            if not self._keys:
+                raise jwks_unavailable()
+            # Keep serving the keys we already have
+            return
+        keys = {}
+        for key in jwks["keys"]:
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"]
+            }
+            keys[key["kid"]] = jwk.construct(rsa_key, ALGORITHMS[0])
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = self._attempted_at = time.monotonic()
+        self.counters["refreshes"] += 1
+
+def jwks_unavailable():
+    return AuthError({"code": "jwks_unavailable",
+                    "description":
+                        "Unable to fetch the signing keys"}, 401)
+
+jwks_cache = JWKSCache()
+
+# Verified-claims cache settings
+CLAIMS_CACHE_SIZE = int(env.get("CLAIMS_CACHE_SIZE", "1024"))
+
+class ClaimsCache:
+    """Bounded LRU of verified token payloads keyed by a digest of the token.
+
+    An entry is dropped once the token's exp has passed, so a cached token
+    is never accepted for longer than jwt.decode would accept it. A size
+    of 0 disables the cache.
+    """
+    def __init__(self, maxsize=CLAIMS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def digest(self, token, audience, issuer):
+        # The expected audience and issuer are part of the key so a payload
+        # is only reused for the checks it was verified against
+        raw = "\n".join((token, audience or "", issuer or ""))
+        return hashlib.sha256(raw.encode()).digest()
+
+    def get(self, digest):
+        if not self.maxsize:
+            return None
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            exp, payload = entry
+            if exp is not None and time.time() >= exp:
+                del self._entries[digest]
+                self.counters["misses"] += 1
+                self.counters["evictions"] += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.counters["hits"] += 1
+            return payload
+
+    def put(self, digest, payload):
+        if not self.maxsize:
+            return
+        exp = payload.get("exp")
+        with self._lock:
+            self._entries[digest] = (exp, payload)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        return dict(self.counters, size=len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+claims_cache = ClaimsCache()
+
 # Verify the JWT in the request's Authorization header
+@timed("auth")
 def verify_jwt(request):
+    # jose is only needed once a request is authenticated
+    from jose import jwt
     if 'Authorization' in request.headers:
         auth_header = request.headers['Authorization'].split()
         token = auth_header[1]
@@ -25,8 +235,15 @@ def verify_jwt(request):
                             "description":
                                 "Authorization header is missing"}, 401)
     
-    jsonurl = urlopen("https://"+ env.get("AUTH0_DOMAIN") +"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    audience = env.get("AUTH0_CLIENT_ID")
+    issuer = "https://"+ env.get("AUTH0_DOMAIN") +"/"
+
+    # Skip signature verification for a token that was already verified
+    digest = claims_cache.digest(token, audience, issuer)
+    payload = claims_cache.get(digest)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -39,24 +256,15 @@ def verify_jwt(request):
                         "description":
                             "Invalid header. "
                             "Use an RS256 signed JWT Access Token"}, 401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
+    rsa_key = jwks_cache.get_key(unverified_header.get("kid"))
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
-                audience=env.get("AUTH0_CLIENT_ID"),
-                issuer="https://"+ env.get("AUTH0_DOMAIN") +"/"
+                audience=audience,
+                issuer=issuer
             )
         except jwt.ExpiredSignatureError:
             raise AuthError({"code": "token_expired",
@@ -72,6 +280,7 @@ def verify_jwt(request):
                                 "Unable to parse authentication"
                                 " token."}, 401)
 
+        claims_cache.put(digest, payload)
         return payload
     else:
         raise AuthError({"code": "no_rsa_key",
@@ -1,11 +1,10 @@
-from flask import Blueprint, request, make_response
-from google.cloud import datastore
+from flask import Blueprint, request, make_response, Response, stream_with_context
 import constants
-import json
+from db import client, new_entity
 from API_errors import *
-from utils import APIError, validate_content_type, get_load, get_boat, create_load_repr
-
-client = datastore.Client()
+from reprs import LoadRepr, links
+from counters import add_owner_stats
+from utils import APIError, dumps, check_volume, counted_volume, validate_content_type, get_load, create_load_repr, create_load_reprs, load_related, make_etag, not_modified, touch, unlink_load, run_in_transaction, get_fields, get_expand, list_params, apply_list_query, project_query, export_ndjson, fetch_page, page_url, get_batch_content, allocate_keys, put_multi, invalidate, invalidate_owner
 
 bp = Blueprint('load', __name__, url_prefix='/loads')
 
@@ -15,57 +14,105 @@ def loads_get_post():
         validate_content_type(request)
 
         content = request.get_json()
-        new_load = datastore.entity.Entity(key=client.key(constants.loads))
+        new_load = new_entity(client.key(constants.loads))
         try:
             new_load.update({
-                "volume": content["volume"],
+                "volume": check_volume(content["volume"]),
                 "carrier": None,
+                "carrier_name": None,
                 "item": content["item"],
                 "creation_date": content["creation_date"]
                 })
         except(KeyError):
             return ERR_400_INVALID_ATTR
+        touch(new_load)
         client.put(new_load)
         # Return the new load attributes
-        data = {
-            "id": new_load.key.id,
-            "volume": new_load["volume"],
-            "carrier": new_load["carrier"],
-            "item": new_load["item"],
-            "creation_date": new_load["creation_date"],
-            "self": request.base_url + '/' + str(new_load.key.id)
-        }
-        res = make_response(data)
+        res = make_response(dumps(create_load_repr(new_load)))
         res.mimetype = constants.application_json
         res.status_code = 201
         return res
     elif request.method == 'GET':
         validate_content_type(request)
-        # Apply pagination to results
+        fields = get_fields(request, constants.load_fields)
+        expand = get_expand(request, constants.load_expand)
         query = client.query(kind=constants.loads)
+        # Read only the properties the response needs. Projections need their
+        # own indexes, so not when filtered.
+        if not apply_list_query(request, query):
+            project_query(query, fields, ("volume", "carrier", "item", "creation_date"))
+        # Apply pagination to results
         q_limit = int(request.args.get('limit', '5'))
         q_offset = int(request.args.get('offset', '0'))
-        l_iterator = query.fetch(limit= q_limit, offset=q_offset)
-        pages = l_iterator.pages
-        results = list(next(pages))
-        if l_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+        q_cursor = request.args.get('cursor')
+        results, next_cursor = fetch_page(query, q_limit, q_cursor, 0 if q_cursor else q_offset)
+        if next_cursor:
+            next_url = page_url(request.base_url, limit=q_limit, cursor=next_cursor, **list_params(request))
         else:
             next_url = None
-        repr_results = []
-        for load in results:
-            repr_results.append(create_load_repr(load))
+        # Answer a poll for an unchanged page without building it
+        related = load_related(results, fields, expand)
+        etag = make_etag(results, fields, expand, related, next_url)
+        not_modified_res = not_modified(request, etag)
+        if not_modified_res:
+            return not_modified_res
+        repr_results = create_load_reprs(results, fields, expand, related)
         data = {"loads": repr_results}
         if next_url:
             data["next"] = next_url
-        res = make_response(json.dumps(data))
+        res = make_response(dumps(data))
         res.mimetype = constants.application_json
         res.status_code = 200
+        res.set_etag(etag)
         return res
     else:
         raise APIError(ERR_405_NO_METHOD)
 
+@bp.route('/export', methods=['GET'])
+def loads_export():
+    fields = get_fields(request, constants.load_fields)
+    expand = get_expand(request, constants.load_expand)
+    query = client.query(kind=constants.loads)
+    if not apply_list_query(request, query):
+        project_query(query, fields, ("volume", "carrier", "item", "creation_date"))
+
+    # Stream every load as one JSON object per line
+    res = Response(stream_with_context(export_ndjson(
+        query, lambda loads: create_load_reprs(loads, fields, expand))))
+    res.mimetype = constants.application_ndjson
+    res.status_code = 200
+    return res
+
+@bp.route('/batch', methods=['POST'])
+def loads_post_batch():
+    content = get_batch_content(request)
+
+    # Create new load entity objects, rejecting the batch if any is invalid
+    keys = allocate_keys(constants.loads, len(content))
+    new_loads = []
+    for key, item in zip(keys, content):
+        new_load = new_entity(key)
+        try:
+            new_load.update({
+                "volume": check_volume(item["volume"]),
+                "carrier": None,
+                "carrier_name": None,
+                "item": item["item"],
+                "creation_date": item["creation_date"]
+                })
+        except(KeyError):
+            raise APIError(ERR_400_INVALID_ATTR)
+        touch(new_load)
+        new_loads.append(new_load)
+    put_multi(new_loads)
+
+    # Return the new load attributes
+    data = {"loads": create_load_reprs(new_loads)}
+    res = make_response(dumps(data))
+    res.mimetype = constants.application_json
+    res.status_code = 201
+    return res
+
 @bp.route('/<id>', methods=['DELETE','GET', 'PUT', 'PATCH'])
 def loads_get_put_patch_delete(id):
     load_key, load = get_load(id)
@@ -73,66 +120,134 @@ def loads_get_put_patch_delete(id):
         # Send 404 error if no boat with the requested id exists
         if not load:
             raise APIError(ERR_404_INVALID_ID)
-        # Get boat carrying this load
-        if load["carrier"]:
-            boat_key = client.key(constants.boats, int(load["carrier"]["id"]))
-            boat = client.get(key=boat_key)
-            for item in boat["loads"]:
-                if item["id"] == id:
-                    boat["loads"].remove(item)
-                    client.put(boat)
-                    continue
-
-        client.delete(load_key)
+        # Take the load off its carrier in the same commit that deletes it
+        def delete():
+            fresh, boat = get_load_and_carrier(load_key, load["carrier"])
+            if not fresh:
+                raise APIError(ERR_404_INVALID_ID)
+            if boat:
+                unlink_load(boat, fresh)
+                add_owner_stats(client, boat["owner"], -1, -counted_volume(fresh))
+                touch(boat)
+                client.put(boat)
+            client.delete(load_key)
+            return boat
+
+        boat = run_in_transaction(client, delete)
+        invalidate(load_key, *([boat] if boat else []))
+        if boat:
+            invalidate_owner(boat["owner"])
         return '', 204
     elif request.method == 'GET':
         validate_content_type(request)
         # Send 404 error if no boat with the requested id exists
         if not load:
             raise APIError(ERR_404_INVALID_ID)
-        load["id"] = load.key.id  # Add id value to response
-        load["self"] = request.base_url  # Add URL to response
-        # Create carrier representation
-        if load["carrier"]:
-            temp = {
-                "id": load["carrier"],
-                "name": get_boat(load["carrier"])[1]["name"],
-                "self": request.host_url + 'boats/' + str(load["carrier"])
-            }
-            load["carrier"] = temp
-        res = make_response(json.dumps(load))
+        fields = get_fields(request, constants.load_fields)
+        expand = get_expand(request, constants.load_expand)
+        related = load_related([load], fields, expand)
+        etag = make_etag([load], fields, expand, related)
+        not_modified_res = not_modified(request, etag)
+        if not_modified_res:
+            return not_modified_res
+        load = create_load_repr(load, fields, expand, related)
+        res = make_response(dumps(load))
         res.status_code = 200
         res.mimetype = constants.application_json
+        res.set_etag(etag)
         return res
     elif request.method == 'PUT':
         validate_content_type(request)
         
+        if not load:
+            raise APIError(ERR_404_INVALID_ID)
+        
         # Replace load entity content
         content = request.get_json()
-        load["volume"] = content["volume"]
-        load["item"] = content["item"]
-        load["creation_date"] = content["creation_date"]
+        load = update_load(load, {
+            "volume": content["volume"],
+            "item": content["item"],
+            "creation_date": content["creation_date"]
+            })
 
-        # Update load
-        client.put(load)
-
-        # Return the load object
-        load["id"] = load.key.id  # Add id value to response
-        load["self"] = request.base_url  # Add boat URL to response
-        res = make_response(json.dumps(load))
+        # Return the load object, with its carrier as a bare id
+        data = LoadRepr(
+            id=load.key.id,
+            volume=load["volume"],
+            carrier=load["carrier"],
+            item=load["item"],
+            creation_date=load["creation_date"],
+            self=links().loads + str(load.key.id))
+        res = make_response(dumps(data))
         res.mimetype = constants.application_json
         res.status_code = 200
         return res
     elif request.method == 'PATCH':
         validate_content_type(request)
         
-        # Replace boat entity content
+        if not load:
+            raise APIError(ERR_404_INVALID_ID)
+        
+        # Replace load entity content; the carrier is only changed through /boats
         content = request.get_json()
-        for attr in content:
-            load[attr] = content[attr]
-
-        # Update load
-        client.put(load)
+        update_load(load, {attr: content[attr] for attr in content
+                           if attr != "carrier" and attr not in constants.unindexed})
         return '', 204
     else:
-        raise APIError(ERR_405_NO_METHOD)
\ No newline at end of file
+        raise APIError(ERR_405_NO_METHOD)
+
+def get_load_and_carrier(load_key, carrier_hint):
+    """Fetch a load and the boat carrying it, in one lookup if the carrier is as expected.
+
+    carrier_hint is the carrier seen on an earlier, possibly cached, read.
+    """
+    keys = [load_key]
+    if carrier_hint:
+        keys.append(client.key(constants.boats, int(carrier_hint)))
+    found = {entity.key: entity for entity in client.get_multi(keys)}
+    load = found.get(load_key)
+    if not load or not load["carrier"]:
+        return load, None
+    boat_key = client.key(constants.boats, int(load["carrier"]))
+    boat = found.get(boat_key) if boat_key in found else client.get(boat_key)
+    return load, boat
+
+def update_load(load, updates):
+    """Apply attribute updates to a load and to the summary and volume its carrier keeps of it.
+
+    load is an earlier read used to find the carrier; the load is read
+    again inside the transaction. Returns the updated load.
+    """
+    if "volume" in updates:
+        check_volume(updates["volume"])
+
+    def update():
+        fresh, boat = get_load_and_carrier(load.key, load["carrier"])
+        if not fresh:
+            raise APIError(ERR_404_INVALID_ID)
+        volume = counted_volume(fresh)
+        fresh.update(updates)
+        changed = [fresh]
+        if boat and "item" in updates and "load_summaries" in boat:
+            for summary in boat["load_summaries"]:
+                if summary["id"] == fresh.key.id:
+                    summary["item"] = fresh["item"]
+            changed.append(boat)
+        difference = counted_volume(fresh) - volume
+        if boat and difference:
+            # Keep the carrier's and its owner's totals in step
+            add_owner_stats(client, boat["owner"], volume=difference)
+            if "load_volume" in boat:
+                boat["load_volume"] += difference
+                if boat not in changed:
+                    changed.append(boat)
+        touch(*changed)
+        client.put_multi(changed)
+        return changed, boat
+
+    changed, boat = run_in_transaction(client, update)
+    invalidate(*changed)
+    # Boat pages can expand the load, so any change to a carried load retires them
+    if boat:
+        invalidate_owner(boat["owner"])
+    return changed[0]
\ No newline at end of file
@@ -1,49 +1,76 @@
-from google.cloud import datastore
-from flask import Flask, url_for, render_template, redirect, make_response
-from os import environ as env
-from dotenv import find_dotenv, load_dotenv
-from authlib.integrations.flask_client import OAuth
-from urllib.parse import quote_plus, urlencode
-
-from jwt import AuthError
-from API_errors import *
-from utils import APIError
-import constants
-import os
-import boat
-import load
-import user
+import startup
+
+with startup.phase("config"):
+    from os import environ as env
+    from dotenv import find_dotenv, load_dotenv
+    import os
+
+    ENV_FILE = find_dotenv()
+    if ENV_FILE:
+        load_dotenv(ENV_FILE)
+
+with startup.phase("flask"):
+    import threading
+    from flask import Flask, url_for, render_template, redirect, make_response
+    from urllib.parse import quote_plus, urlencode
+
+with startup.phase("blueprints"):
+    from jwt import AuthError, jwks_cache, claims_cache
+    from API_errors import *
+    from utils import APIError, get_user_from_sub
+    import constants
+    from cache import entity_cache, page_cache
+    import db
+    import metrics
+    import compression
+    from db import client, new_entity
+    import boat
+    import load
+    import user
 
 DEBUG = True
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = 'google_creds.json'
 
-client = datastore.Client()
-
-ENV_FILE = find_dotenv()
-if ENV_FILE:
-    load_dotenv(ENV_FILE)
-
-app = Flask(__name__)
-app.register_blueprint(boat.bp)
-app.register_blueprint(load.bp)
-app.register_blueprint(user.bp)
-
-app.secret_key = env.get("APP_SECRET_KEY")
-
-oauth = OAuth(app)
-
-oauth.register(
-    "auth0",
-    client_id=env.get("AUTH0_CLIENT_ID"),
-    client_secret=env.get("AUTH0_CLIENT_SECRET"),
-    client_kwargs={
-        "scope": "openid profile email",
-    },
-    server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration'
-)
-
-client = datastore.Client()
+with startup.phase("app"):
+    app = Flask(__name__)
+    db.init_app(app)
+    metrics.init_app(app)
+    compression.init_app(app)
+    metrics.register_stats("jwks", jwks_cache.stats)
+    metrics.register_stats("claims", claims_cache.stats)
+    metrics.register_stats("entity", entity_cache.stats)
+    metrics.register_stats("pages", page_cache.stats)
+    app.register_blueprint(boat.bp)
+    app.register_blueprint(load.bp)
+    app.register_blueprint(user.bp)
+
+    app.secret_key = env.get("APP_SECRET_KEY")
+
+_oauth = None
+_oauth_lock = threading.Lock()
+
+def get_oauth():
+    """Create the Auth0 OAuth client on first use so authlib stays out of cold start"""
+    global _oauth
+    if _oauth is None:
+        with _oauth_lock:
+            if _oauth is None:
+                from authlib.integrations.flask_client import OAuth
+                oauth = OAuth(app)
+                oauth.register(
+                    "auth0",
+                    client_id=env.get("AUTH0_CLIENT_ID"),
+                    client_secret=env.get("AUTH0_CLIENT_SECRET"),
+                    client_kwargs={
+                        "scope": "openid profile email",
+                    },
+                    server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration'
+                )
+                _oauth = oauth
+    return _oauth
+
+startup.finish(app)
 
 # ---------------------------------------------
 #           ERROR HANDLER ROUTES
@@ -72,22 +99,20 @@ def home():
 
 @app.route("/login")
 def login():
-    return oauth.auth0.authorize_redirect(
+    return get_oauth().auth0.authorize_redirect(
         redirect_uri=url_for("callback", _external=True)
     )
 
 @app.route("/userinfo", methods=["GET", "POST"])
 def callback():
     # get token from auth0
-    token = oauth.auth0.authorize_access_token()
+    token = get_oauth().auth0.authorize_access_token()
     
     # check if user already exists in database
-    query = client.query(kind=constants.users)
-    query.add_filter("sub", "=", token['userinfo']['sub'])
-    user = list(query.fetch(limit=1))
+    user = get_user_from_sub(token['userinfo']['sub'])
     if not user:
-        # store user in Google Datastore
-        new_user = datastore.entity.Entity(key=client.key(constants.users))
+        # store user in Google Datastore, keyed by sub
+        new_user = new_entity(client.key(constants.users, token['userinfo']['sub']))
         new_user.update({
             'sub': token['userinfo']['sub'],
             'name': token['userinfo']['name'],
@@ -96,6 +121,14 @@ def callback():
         client.put(new_user)
     return render_template("home.html", token=token)
 
+@app.route("/_ah/warmup")
+def warmup():
+    # App Engine warmup request: load what cold start deferred before real traffic arrives
+    get_oauth()
+    db.get_client()
+    from jose import jwt
+    return '', 200
+
 @app.route("/logout")
 def logout():
     return redirect(
@@ -0,0 +1,352 @@
+"""Request-level performance metrics.
+
+Every request is timed into a per-route latency histogram. A sample of
+requests, chosen by METRICS_SAMPLE_RATE, is also traced: Datastore calls
+made through db.client are counted and timed by RPC name, and code
+wrapped in span() (auth, serialization) is timed by phase. A traced
+request reports its breakdown in a Server-Timing header.
+
+Everything is exported in the Prometheus text format at /metrics, along
+with response compression totals and the stats of any cache registered
+through register_stats().
+"""
+import functools
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from os import environ as env
+
+from flask import g, has_app_context, request
+
+# Fraction of requests traced in detail: 1 traces every request, 0 none
+METRICS_SAMPLE_RATE = float(env.get("METRICS_SAMPLE_RATE", "1"))
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+prometheus_text = "text/plain; version=0.0.4; charset=utf-8"
+
+class Trace:
+    """Call counts and durations recorded for one sampled request"""
+    __slots__ = ("spans", "finished")
+
+    def __init__(self):
+        self.spans = defaultdict(lambda: [0, 0.0])
+        self.finished = False
+
+    def add(self, name, seconds):
+        if not self.finished:
+            span = self.spans[name]
+            span[0] += 1
+            span[1] += seconds
+
+    def server_timing(self, total):
+        entries = ['%s;dur=%.2f;desc="%d"' % (name, seconds * 1000, count)
+                   for name, (count, seconds) in sorted(self.spans.items())]
+        entries.append("total;dur=%.2f" % (total * 1000))
+        return ", ".join(entries)
+
+def current_trace():
+    """Return the trace of the current request, or None if it is not sampled"""
+    if has_app_context():
+        return g.get("_metrics_trace")
+    return None
+
+@contextmanager
+def span(name):
+    """Time a block of work as part of the current request's trace"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+def timed(name):
+    """Decorator form of span()"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Datastore tracing
+
+class TracedClient:
+    """Wraps a storage client and records each RPC it makes in a trace.
+
+    Writes made inside a transaction are buffered by the client and sent
+    with the commit, so only the commit is recorded for them.
+    """
+    def __init__(self, client, trace):
+        self._client = client
+        self._trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _call(self, rpc, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._trace.add("db-" + rpc, time.perf_counter() - start)
+
+    def _write(self, fn, *args, **kwargs):
+        if self._client.current_transaction is not None:
+            return fn(*args, **kwargs)
+        return self._call("commit", fn, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._call("lookup", self._client.get, *args, **kwargs)
+
+    def get_multi(self, *args, **kwargs):
+        return self._call("lookup", self._client.get_multi, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self._write(self._client.put, *args, **kwargs)
+
+    def put_multi(self, *args, **kwargs):
+        return self._write(self._client.put_multi, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._write(self._client.delete, *args, **kwargs)
+
+    def delete_multi(self, *args, **kwargs):
+        return self._write(self._client.delete_multi, *args, **kwargs)
+
+    def allocate_ids(self, *args, **kwargs):
+        return self._call("allocateIds", self._client.allocate_ids, *args, **kwargs)
+
+    def query(self, **kwargs):
+        return TracedQuery(self._client.query(**kwargs), self)
+
+    def transaction(self, **kwargs):
+        return TracedTransaction(self._client.transaction(**kwargs), self)
+
+class TracedQuery:
+    def __init__(self, query, traced_client):
+        self._query = query
+        self._traced_client = traced_client
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        return TracedIterator(self._query.fetch(*args, **kwargs), self._traced_client)
+
+class TracedIterator:
+    """Records one runQuery per page, which is one RPC per page in Datastore"""
+    def __init__(self, iterator, traced_client):
+        self._iterator = iterator
+        self._traced_client = traced_client
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    @property
+    def pages(self):
+        pages = self._iterator.pages
+        while True:
+            try:
+                page = self._traced_client._call("runQuery", next, pages)
+            except StopIteration:
+                return
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+class TracedTransaction:
+    def __init__(self, transaction, traced_client):
+        self._transaction = transaction
+        self._traced_client = traced_client
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+        self._traced_client._call("beginTransaction", self._transaction.__enter__)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        rpc = "commit" if exc_type is None else "rollback"
+        return self._traced_client._call(rpc, self._transaction.__exit__, exc_type, exc, tb)
+
+def traced_client(client):
+    """Return client wrapped for the current request's trace, if it has one"""
+    trace = current_trace()
+    if trace is None:
+        return client
+    wrapped = g.get("_metrics_client")
+    if wrapped is None or wrapped._client is not client:
+        wrapped = g._metrics_client = TracedClient(client, trace)
+    return wrapped
+
+# Aggregation
+
+class Registry:
+    """Process-wide totals, rendered in the Prometheus text format"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # (route, method) -> [bucket counts, sum, count]
+        self._requests = defaultdict(int)  # (route, method, status) -> count
+        self._spans = defaultdict(lambda: [0, 0.0])  # span name -> [count, seconds]
+        self._traced = 0
+        self._compression = defaultdict(lambda: [0, 0, 0, 0.0])  # encoding -> [responses, bytes in, bytes out, CPU seconds]
+        self._stats = {}
+
+    def observe(self, route, method, status, seconds, trace=None):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get((route, method))
+            if histogram is None:
+                histogram = self._histograms[(route, method)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self._requests[(route, method, status)] += 1
+            if trace is not None:
+                self._traced += 1
+                for name, (count, duration) in trace.spans.items():
+                    total = self._spans[name]
+                    total[0] += count
+                    total[1] += duration
+
+    def observe_compression(self, encoding, raw_bytes, sent_bytes, cpu_seconds):
+        """Record one response body; encoding is "identity" if it was sent uncompressed"""
+        with self._lock:
+            total = self._compression[encoding]
+            total[0] += 1
+            total[1] += raw_bytes
+            total[2] += sent_bytes
+            total[3] += cpu_seconds
+
+    def register_stats(self, name, stats):
+        """Export the counters returned by stats() as api_cache_<counter>{cache=name}"""
+        self._stats[name] = stats
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = {label: (list(h[0]), h[1], h[2]) for label, h in self._histograms.items()}
+            requests = dict(self._requests)
+            spans = {name: tuple(total) for name, total in self._spans.items()}
+            traced = self._traced
+            compression = {encoding: tuple(total) for encoding, total in self._compression.items()}
+
+        lines.append("# HELP api_request_duration_seconds Request latency by route")
+        lines.append("# TYPE api_request_duration_seconds histogram")
+        for (route, method), (counts, total, count) in sorted(histograms.items()):
+            labels = 'route="%s",method="%s"' % (_escape(route), method)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('api_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+            lines.append("api_request_duration_seconds_sum{%s} %f" % (labels, total))
+            lines.append("api_request_duration_seconds_count{%s} %d" % (labels, count))
+
+        lines.append("# HELP api_requests_total Requests by route and status")
+        lines.append("# TYPE api_requests_total counter")
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append('api_requests_total{route="%s",method="%s",status="%d"} %d'
+                         % (_escape(route), method, status, count))
+
+        lines.append("# HELP api_traced_requests_total Requests sampled for tracing")
+        lines.append("# TYPE api_traced_requests_total counter")
+        lines.append("api_traced_requests_total %d" % traced)
+
+        lines.append("# HELP api_span_calls_total Calls made by traced requests, by Datastore RPC or phase")
+        lines.append("# TYPE api_span_calls_total counter")
+        for name, (count, _) in sorted(spans.items()):
+            lines.append('api_span_calls_total{span="%s"} %d' % (name, count))
+        lines.append("# HELP api_span_seconds_total Time spent by traced requests, by Datastore RPC or phase")
+        lines.append("# TYPE api_span_seconds_total counter")
+        for name, (_, seconds) in sorted(spans.items()):
+            lines.append('api_span_seconds_total{span="%s"} %f' % (name, seconds))
+
+        lines.append("# HELP api_compression_responses_total Compressible responses by content coding")
+        lines.append("# TYPE api_compression_responses_total counter")
+        for encoding, (count, _, _, _) in sorted(compression.items()):
+            lines.append('api_compression_responses_total{encoding="%s"} %d' % (encoding, count))
+        lines.append("# HELP api_compression_input_bytes_total Response bytes before compression")
+        lines.append("# TYPE api_compression_input_bytes_total counter")
+        for encoding, (_, raw, _, _) in sorted(compression.items()):
+            lines.append('api_compression_input_bytes_total{encoding="%s"} %d' % (encoding, raw))
+        lines.append("# HELP api_compression_output_bytes_total Response bytes sent")
+        lines.append("# TYPE api_compression_output_bytes_total counter")
+        for encoding, (_, _, sent, _) in sorted(compression.items()):
+            lines.append('api_compression_output_bytes_total{encoding="%s"} %d' % (encoding, sent))
+        lines.append("# HELP api_compression_cpu_seconds_total CPU time spent compressing")
+        lines.append("# TYPE api_compression_cpu_seconds_total counter")
+        for encoding, (_, _, _, seconds) in sorted(compression.items()):
+            lines.append('api_compression_cpu_seconds_total{encoding="%s"} %f' % (encoding, seconds))
+
+        for name, stats in sorted(self._stats.items()):
+            for counter, value in sorted(_flatten(stats()).items()):
+                lines.append('api_cache_%s{cache="%s"} %s' % (counter, name, value))
+        return "\n".join(lines) + "\n"
+
+def _flatten(stats, prefix=""):
+    # Nested stats such as {"local": {"hits": 1}} become local_hits
+    flat = {}
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + name + "_"))
+        elif isinstance(value, (int, float)):
+            flat[prefix + name] = value
+    return flat
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+registry = Registry()
+
+def register_stats(name, stats):
+    registry.register_stats(name, stats)
+
+def init_app(app, sample_rate=None):
+    """Time every request made to app and serve the totals at /metrics"""
+    rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    @app.before_request
+    def start_request():
+        g._metrics_start = time.perf_counter()
+        if rate and random.random() < rate:
+            g._metrics_trace = Trace()
+
+    @app.after_request
+    def finish_request(response):
+        start = g.get("_metrics_start")
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        trace = g.get("_metrics_trace")
+        if trace is not None:
+            # Work done while a streamed body is sent is not counted
+            trace.finished = True
+            response.headers["Server-Timing"] = trace.server_timing(total)
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        registry.observe(route, request.method, response.status_code, total, trace)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return registry.render(), 200, {"Content-Type": prometheus_text}
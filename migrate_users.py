@@ -0,0 +1,68 @@
+"""Re-key legacy user entities by their Auth0 sub.
+
+Usage: python migrate_users.py [--dry-run] [--batch-size N]
+
+Users created before the users kind was keyed by sub have numeric ids.
+Each batch copies those users to a key named after their sub, merging the
+boats list into any entity that already exists under that key, and then
+deletes the numeric-id originals. Running the tool again is safe.
+"""
+import argparse
+
+from google.cloud import datastore
+
+import constants
+from db import get_client
+
+
+def migrate_batch(client, users, dry_run):
+    legacy = [user for user in users if user.key.id is not None and user.get("sub")]
+    if not legacy:
+        return 0
+
+    new_keys = [client.key(constants.users, user["sub"]) for user in legacy]
+    existing = {entity.key.name: entity for entity in client.get_multi(list(set(new_keys)))}
+
+    migrated = {}
+    for user, new_key in zip(legacy, new_keys):
+        target = migrated.get(new_key.name) or existing.get(new_key.name)
+        if target is None:
+            target = datastore.Entity(key=new_key)
+            target.update(user)
+        else:
+            # Keep every boat from both entities
+            target["boats"] = list(dict.fromkeys(list(target.get("boats", [])) + list(user.get("boats", []))))
+            if not target.get("name"):
+                target["name"] = user.get("name")
+        migrated[new_key.name] = target
+
+    if not dry_run:
+        client.put_multi(list(migrated.values()))
+        client.delete_multi([user.key for user in legacy])
+    return len(legacy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report without writing")
+    parser.add_argument("--batch-size", type=int, default=250,
+                        help="users per batch (at most 250 so each batch stays within one commit)")
+    args = parser.parse_args()
+    batch_size = min(args.batch_size, constants.max_mutations // 2)
+
+    client = get_client()
+    query = client.query(kind=constants.users)
+    total = 0
+    cursor = None
+    while True:
+        iterator = query.fetch(limit=batch_size, start_cursor=cursor)
+        users = list(next(iterator.pages))
+        total += migrate_batch(client, users, args.dry_run)
+        cursor = iterator.next_page_token
+        if not cursor or len(users) < batch_size:
+            break
+    print("%s %d users" % ("Would migrate" if args.dry_run else "Migrated", total))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Rebuild the load totals kept on boats and owners.
+
+Usage: python reconcile_stats.py [--dry-run] [--batch-size N]
+
+Boats keep the volume of their loads in load_volume, and owners keep load
+counts and volumes in owner_stats shards (see counters.py). Every write
+updates them as it goes; this job recomputes them from the loads and
+repairs any that drifted, or were never set because the entity predates
+them. Running it again is safe. Totals changed while it runs can drift
+again, so run it when writes are quiet.
+"""
+import argparse
+from collections import defaultdict
+
+import constants
+from backfill_summaries import lookup, walk
+from counters import OWNER_STATS_SHARDS, new_shard, shard_key
+from db import get_client
+from utils import counted_volume, run_in_transaction, touch
+
+
+def reconcile_boats(client, keys, dry_run, totals):
+    """Recompute load_volume on a batch of boats and add them to their owners' totals"""
+    def reconcile():
+        boats = client.get_multi(keys)
+        loads = lookup(client, constants.loads, [i for boat in boats for i in boat["loads"]])
+        changed = []
+        counts = []
+        for boat in boats:
+            # Only loads that name the boat as their carrier are on it
+            carried = [loads[i] for i in boat["loads"] if i in loads and loads[i]["carrier"] == boat.key.id]
+            volume = sum(counted_volume(load) for load in carried)
+            counts.append((boat["owner"], len(carried), volume))
+            if boat.get("load_volume") != volume:
+                boat["load_volume"] = volume
+                changed.append(boat)
+        if changed and not dry_run:
+            touch(*changed)
+            client.put_multi(changed)
+        return counts, len(changed)
+
+    counts, changed = run_in_transaction(client, reconcile)
+    # Counted once the transaction has committed, so retries are not counted twice
+    for owner, loads, volume in counts:
+        total = totals[owner]
+        total[0] += loads
+        total[1] += volume
+    return changed
+
+
+def reconcile_owner(client, sub, total, shards, dry_run):
+    """Replace an owner's shards with a single one holding total, if they disagree"""
+    def reconcile():
+        keys = [shard_key(client, sub, shard) for shard in sorted(set(range(OWNER_STATS_SHARDS)) | shards)]
+        found = client.get_multi(keys)
+        # Shards past OWNER_STATS_SHARDS are not read, so they do not count
+        current = [0, 0]
+        stale = []
+        for entity in found:
+            if int(entity.key.name.rsplit(":", 1)[1]) < OWNER_STATS_SHARDS:
+                current[0] += entity["loads"]
+                current[1] += entity["volume"]
+            else:
+                stale.append(entity.key)
+        if current == total and not stale:
+            return False
+        if not dry_run:
+            first = new_shard(shard_key(client, sub, 0), sub)
+            first["loads"], first["volume"] = total
+            client.put(first)
+            client.delete_multi([entity.key for entity in found if entity.key != first.key])
+        return True
+    return run_in_transaction(client, reconcile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report without writing")
+    parser.add_argument("--batch-size", type=int, default=250,
+                        help="boats per transaction (at most %d)" % constants.max_mutations)
+    args = parser.parse_args()
+    batch_size = min(args.batch_size, constants.max_mutations)
+
+    client = get_client()
+    verb = "Would update" if args.dry_run else "Updated"
+    totals = defaultdict(lambda: [0, 0])
+    boats = walk(client, constants.boats, batch_size,
+                 lambda client, keys, dry_run: reconcile_boats(client, keys, dry_run, totals),
+                 args.dry_run)
+    print("%s %d boats" % (verb, boats))
+
+    # Owners with shards but no boats left are reset to zero
+    shards = defaultdict(set)
+
+    def collect(client, keys, dry_run):
+        for key in keys:
+            sub, shard = key.name.rsplit(":", 1)
+            shards[sub].add(int(shard))
+        return 0
+    walk(client, constants.owner_stats, batch_size, collect, args.dry_run)
+
+    owners = 0
+    for sub in set(totals) | set(shards):
+        owners += reconcile_owner(client, sub, totals[sub], shards[sub], args.dry_run)
+    print("%s %d owners" % (verb, owners))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Response objects and JSON encoding.
+
+Representations are immutable __slots__ objects built from entities
+without modifying them, so an entity can be shared with the entity cache
+while it is being represented. Attributes left out by ?fields=, or not
+expanded, are MISSING and are not encoded.
+
+encode() uses orjson when it is installed and the standard library
+otherwise. Set JSON_BACKEND to "orjson" or "json" to choose one.
+"""
+import json
+from os import environ as env
+
+from flask import g, has_request_context, request
+
+JSON_BACKEND = env.get("JSON_BACKEND")
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+MISSING = _Missing()
+
+class Repr:
+    """Immutable response object; subclasses list their attributes in __slots__"""
+    __slots__ = ()
+    _setters = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Slot descriptors set attributes faster than object.__setattr__
+        cls._setters = tuple((name, cls.__dict__[name].__set__) for name in cls.__slots__)
+
+    # Positional-only, so that "self" can be passed as an attribute value
+    def __init__(self, fields=None, /, **values):
+        for name, set_slot in self._setters:
+            set_slot(self, values.get(name, MISSING) if fields is None or name in fields else MISSING)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.as_dict())
+
+    def as_dict(self):
+        values = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not MISSING:
+                values[name] = value
+        return values
+
+class BoatRepr(Repr):
+    __slots__ = ("id", "name", "length", "date_built", "owner", "loads", "self")
+
+class LoadRepr(Repr):
+    __slots__ = ("id", "volume", "carrier", "item", "creation_date", "self")
+
+class LoadRef(Repr):
+    """A load as listed on its boat; item is only set when expanded"""
+    __slots__ = ("id", "item", "self")
+
+class CarrierRef(Repr):
+    """The boat carrying a load; name is only set when expanded"""
+    __slots__ = ("id", "name", "self")
+
+class Links:
+    """URL prefixes for one request, computed once"""
+    __slots__ = ("boats", "loads")
+
+    def __init__(self, url_root):
+        self.boats = url_root + "boats/"
+        self.loads = url_root + "loads/"
+
+def links():
+    """Return the URL prefixes of the current request"""
+    if not has_request_context():
+        raise RuntimeError("links() needs a request")
+    current = g.get("_links")
+    if current is None:
+        current = g._links = Links(request.url_root)
+    return current
+
+# Encoding
+
+def _default(obj):
+    if isinstance(obj, Repr):
+        return obj.as_dict()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+def _orjson_encoder():
+    import orjson
+
+    def encode(data):
+        return orjson.dumps(data, default=_default).decode()
+    return encode
+
+def _json_encoder():
+    encoder = json.JSONEncoder(separators=(",", ":"), default=_default)
+    return encoder.encode
+
+def _load_encoder(backend):
+    if backend == "json":
+        return _json_encoder()
+    try:
+        return _orjson_encoder()
+    except ImportError:
+        if backend == "orjson":
+            raise
+        return _json_encoder()
+
+_encode = None
+
+def encode(data):
+    """Serialize data, including any representations in it, to a JSON string"""
+    global _encode
+    if _encode is None:
+        _encode = _load_encoder(JSON_BACKEND)
+    return _encode(data)
+
+def set_backend(backend):
+    """Switch the JSON backend, e.g. from a benchmark; None picks the default"""
+    global _encode
+    _encode = _load_encoder(backend)
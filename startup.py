@@ -0,0 +1,47 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from os import environ as env
+
+# Where to write the startup profile: a file path, "-" for stderr, unset to skip
+STARTUP_PROFILE = env.get("STARTUP_PROFILE")
+
+_started = time.perf_counter()
+phases = []
+profile = {}
+
+@contextmanager
+def phase(name):
+    """Record how long a block of startup work takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, (time.perf_counter() - start) * 1000))
+
+def finish(app):
+    """Close the import profile and time the first request served by app"""
+    profile["phases_ms"] = dict(phases)
+    profile["import_ms"] = (time.perf_counter() - _started) * 1000
+    dump()
+
+    served = []
+
+    @app.after_request
+    def record_first_response(response):
+        if not served:
+            served.append(True)
+            profile["first_response_ms"] = (time.perf_counter() - _started) * 1000
+            dump()
+        return response
+
+def dump():
+    if not STARTUP_PROFILE:
+        return
+    data = json.dumps(profile, sort_keys=True)
+    if STARTUP_PROFILE == "-":
+        print(data, file=sys.stderr)
+    else:
+        with open(STARTUP_PROFILE, "w") as f:
+            f.write(data)
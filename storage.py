@@ -0,0 +1,361 @@
+"""Storage backends for the API.
+
+Every module reaches storage through db.client, which must provide this
+subset of the google.cloud.datastore.Client interface:
+
+    key(kind, id_or_name=None)
+    get(key), get_multi(keys)
+    put(entity), put_multi(entities)
+    delete(key), delete_multi(keys)
+    allocate_ids(incomplete_key, num_ids)
+    query(kind=...) with add_filter(), order, projection, keys_only() and
+        fetch(limit, offset, start_cursor) returning an iterator with
+        pages and next_page_token
+    transaction(), used as a context manager
+
+The Datastore backend is the client library itself (see db.create_client).
+MemoryClient is an in-process stand-in for local benchmarks and load
+tests. It counts calls by Datastore RPC name and can add a fixed latency
+to each RPC, so the results are deterministic and need no GCP project.
+"""
+import base64
+import copy
+import datetime
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+
+from google.api_core.exceptions import InvalidArgument
+from google.cloud.datastore import Entity, Key
+
+MEMORY_PROJECT = "memory"
+
+# Datastore rejects commits with more mutations than this
+MAX_MUTATIONS = 500
+
+# Results per batch for a query without a limit; Datastore also returns
+# long result sets in batches, one RPC each
+QUERY_BATCH_SIZE = 300
+
+# Datastore sorts values of different types in this order
+_TYPE_RANK = {type(None): 0, int: 1, float: 1, datetime.datetime: 2, bool: 3, bytes: 4, str: 5}
+
+def _sort_value(value):
+    return (_TYPE_RANK.get(type(value), 6), value)
+
+def _key_order(key):
+    # Numeric ids sort before names, as in Datastore
+    return (key.kind, 0, key.id, "") if key.id is not None else (key.kind, 1, 0, key.name)
+
+class MemoryIterator:
+    """Result iterator with the pages/next_page_token shape of the real one"""
+    def __init__(self, query, limit, offset, start_cursor):
+        self._query = query
+        self._limit = limit
+        self._offset = offset or 0
+        self._start_cursor = start_cursor
+        self.next_page_token = None
+        self.num_results = 0
+
+    @property
+    def pages(self):
+        page = self._run()
+        if self._limit is not None or len(page) <= QUERY_BATCH_SIZE:
+            yield iter([self._query._result(entity) for entity in page])
+            return
+        # Entities are copied one batch at a time, so memory stays flat
+        for start in range(0, len(page), QUERY_BATCH_SIZE):
+            if start:
+                self._query._client._rpc("runQuery")
+            yield iter([self._query._result(entity) for entity in page[start:start + QUERY_BATCH_SIZE]])
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def _run(self):
+        client = self._query._client
+        client._rpc("runQuery")
+        rows = self._query._matches()
+        start = 0
+        if self._start_cursor:
+            position = client._decode_cursor(self._start_cursor)
+            start = next((i for i, row in enumerate(rows) if row[0] > position), len(rows))
+        start += self._offset
+        end = len(rows) if self._limit is None else start + self._limit
+        page = rows[start:end]
+        if self._limit is not None and end < len(rows) and page:
+            self.next_page_token = client._encode_cursor(page[-1][0])
+        else:
+            self.next_page_token = None
+        self.num_results = len(page)
+        return [entity for _, entity in page]
+
+class MemoryQuery:
+    _OPERATORS = {
+        "=": lambda a, b: a == b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "!=": lambda a, b: a != b,
+    }
+
+    def __init__(self, client, kind=None, filters=(), order=(), projection=()):
+        self._client = client
+        self.kind = kind
+        self.filters = list(filters)
+        self.order = list(order)
+        self.projection = list(projection)
+        self._keys_only = False
+
+    def add_filter(self, property_name, operator, value):
+        if operator not in self._OPERATORS:
+            raise ValueError("Invalid expression: %r" % operator)
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+        self._keys_only = True
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, **kwargs):
+        return MemoryIterator(self, limit, offset, start_cursor)
+
+    def _match(self, entity):
+        for name, operator, value in self.filters:
+            if name not in entity:
+                return False
+            compare = self._OPERATORS[operator]
+            values = entity[name] if isinstance(entity[name], list) else [entity[name]]
+            # Datastore only compares values of the same type
+            if not any(_sort_value(v)[0] == _sort_value(value)[0] and compare(v, value) for v in values):
+                return False
+        return True
+
+    def _matches(self):
+        with self._client._lock:
+            entities = list(self._client._store.get(self.kind, {}).values())
+        entities = [e for e in entities if self._match(e)]
+        # Entities missing an ordered property are not returned, as in Datastore
+        for name in self.order:
+            entities = [e for e in entities if name.lstrip("-") in e]
+        rows = []
+        for entity in entities:
+            position = tuple(
+                (-_sort_value(entity[name[1:]])[0], _Reversed(entity[name[1:]])) if name.startswith("-")
+                else _sort_value(entity[name])
+                for name in self.order) + (_key_order(entity.key),)
+            rows.append((position, entity))
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def _result(self, entity):
+        if self._keys_only:
+            result = Entity(key=entity.key)
+        elif self.projection:
+            result = Entity(key=entity.key)
+            for name in self.projection:
+                if name in entity:
+                    result[name] = copy.deepcopy(entity[name])
+        else:
+            result = self._client._copy(entity)
+        return result
+
+class _Reversed:
+    """Inverts comparisons for descending sort orders"""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
+class MemoryTransaction:
+    """Buffers writes and applies them in one commit.
+
+    Transactions are serialised, so they never abort with contention.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._puts = []
+        self._deletes = []
+
+    def put(self, entity):
+        self._puts.append(entity)
+
+    def delete(self, key):
+        self._deletes.append(key)
+
+    def __enter__(self):
+        self._client._txn_lock.acquire()
+        self._client._rpc("beginTransaction")
+        self._client._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._client._local.transaction = None
+        try:
+            if exc_type is None:
+                self._client._commit(self._puts, self._deletes)
+            else:
+                self._client._rpc("rollback")
+        finally:
+            self._client._txn_lock.release()
+        return False
+
+class MemoryClient:
+    """In-memory implementation of the storage interface"""
+    def __init__(self, project=MEMORY_PROJECT, namespace=None, rpc_latency=0.0):
+        self.project = project
+        self.namespace = namespace
+        self.rpc_latency = rpc_latency
+        self.counters = Counter()
+        self._store = {}  # kind -> {id or name -> entity}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._txn_lock = threading.RLock()
+        self._local = threading.local()
+
+    # Interface
+
+    def key(self, kind, id_or_name=None):
+        if id_or_name is None:
+            return Key(kind, project=self.project, namespace=self.namespace)
+        return Key(kind, id_or_name, project=self.project, namespace=self.namespace)
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, **kwargs):
+        keys = list(keys)
+        if not keys:
+            return []
+        self._rpc("lookup")
+        with self._lock:
+            found = [self._store.get(key.kind, {}).get(key.id_or_name) for key in keys]
+        return [self._copy(entity) for entity in found if entity is not None]
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        entities = list(entities)
+        if not entities:
+            return
+        for entity in entities:
+            if entity.key.is_partial:
+                entity.key = entity.key.completed_key(next(self._ids))
+        transaction = self.current_transaction
+        if transaction is not None:
+            for entity in entities:
+                transaction.put(entity)
+            return
+        self._commit(entities, [])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        transaction = self.current_transaction
+        if transaction is not None:
+            for key in keys:
+                transaction.delete(key)
+            return
+        self._commit([], keys)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        self._rpc("allocateIds")
+        return [incomplete_key.completed_key(next(self._ids)) for _ in range(num_ids)]
+
+    def query(self, **kwargs):
+        return MemoryQuery(self, **kwargs)
+
+    def transaction(self, **kwargs):
+        return MemoryTransaction(self)
+
+    @property
+    def current_transaction(self):
+        return getattr(self._local, "transaction", None)
+
+    # Instrumentation
+
+    def reset_counters(self):
+        self.counters.clear()
+
+    def rpc_count(self):
+        return sum(self.counters.values())
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+        self.reset_counters()
+
+    # Internals
+
+    def _rpc(self, name):
+        self.counters[name] += 1
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+
+    def _copy(self, entity):
+        # Callers get their own copy, like entities decoded from an RPC
+        result = Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+        result.update(copy.deepcopy(dict(entity)))
+        return result
+
+    def _commit(self, puts, deletes):
+        self._rpc("commit")
+        if len(puts) + len(deletes) > MAX_MUTATIONS:
+            raise InvalidArgument("cannot write more than %d entities in a single call" % MAX_MUTATIONS)
+        self._apply(puts, deletes)
+
+    def _apply(self, puts, deletes):
+        with self._lock:
+            for entity in puts:
+                self._store.setdefault(entity.key.kind, {})[entity.key.id_or_name] = self._copy(entity)
+            for key in deletes:
+                self._store.get(key.kind, {}).pop(key.id_or_name, None)
+
+    def _encode_cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps(_jsonable(position)).encode()).decode()
+
+    def _decode_cursor(self, cursor):
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode()
+        try:
+            return _from_jsonable(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+def _jsonable(value):
+    if isinstance(value, _Reversed):
+        return {"r": _jsonable(value.value)}
+    if isinstance(value, tuple):
+        return {"t": [_jsonable(v) for v in value]}
+    return value
+
+def _from_jsonable(value):
+    if isinstance(value, dict) and "r" in value:
+        return _Reversed(_from_jsonable(value["r"]))
+    if isinstance(value, dict) and "t" in value:
+        return tuple(_from_jsonable(v) for v in value["t"])
+    return value
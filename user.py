@@ -1,33 +1,66 @@
-from flask import Blueprint, request, make_response
-from google.cloud import datastore
+from flask import Blueprint, request, make_response, Response, stream_with_context
 import constants
-import json
+from db import client
 from API_errors import *
-from utils import APIError, validate_content_type, get_boat
-
-client = datastore.Client()
+from utils import APIError, dumps, validate_content_type, get_multi, fetch_page, iter_pages, page_url
 
 bp = Blueprint('user', __name__, url_prefix='/users')
 
+# Number of users read per RPC when streaming the full list
+STREAM_PAGE_SIZE = 100
+
+def create_user_reprs(users, url_root):
+    """Build user representations, resolving every boat name with one batched lookup"""
+    boat_ids = [boat for user in users for boat in user["boats"]]
+    boats = get_multi(constants.boats, boat_ids, copy=False)
+    for user in users:
+        rep_boats = []
+        for boat in user["boats"]:
+            boat_entity = boats.get(int(boat))
+            temp = {}
+            temp["id"] = boat
+            temp["name"] = boat_entity["name"] if boat_entity else None
+            temp["self"] = url_root + 'boats/' + str(boat)
+            rep_boats.append(temp)
+        user["boats"] = rep_boats
+    return users
+
+def stream_users(query, url_root):
+    # Emit a JSON array one page at a time so the whole kind is never in memory
+    # Each page is sent as a single chunk, which a compressed stream flushes whole
+    separator = '['
+    for page in iter_pages(query, STREAM_PAGE_SIZE):
+        users = create_user_reprs(page, url_root)
+        if users:
+            yield separator + ', '.join(dumps(user) for user in users)
+            separator = ', '
+    yield '[]' if separator == '[' else ']'
+
 @bp.route("", methods=['GET'])
 def users_get():
     if request.method == 'GET':
         validate_content_type(request)
 
         query = client.query(kind=constants.users)
-        data = list(query.fetch())
-        for user in data:
-            rep_boats = []
-            for boat in user["boats"]:
-                temp = {}
-                temp["id"] = boat
-                temp["name"] = get_boat(boat)[1]["name"]
-                temp["self"] = request.url_root + 'boats/' + str(boat)
-                rep_boats.append(temp)
-            user["boats"] = rep_boats
-        res = make_response(json.dumps(data))
+
+        # Without paging parameters stream the complete list
+        if 'limit' not in request.args and 'cursor' not in request.args:
+            res = Response(stream_with_context(stream_users(query, request.url_root)))
+            res.mimetype = constants.application_json
+            res.status_code = 200
+            return res
+
+        # Apply pagination to results
+        q_limit = int(request.args.get('limit', '5'))
+        q_cursor = request.args.get('cursor')
+        results, next_cursor = fetch_page(query, q_limit, q_cursor)
+        data = {"users": create_user_reprs(results, request.url_root)}
+        # Add url of next page to output
+        if next_cursor:
+            data["next"] = page_url(request.base_url, limit=q_limit, cursor=next_cursor)
+        res = make_response(dumps(data))
         res.mimetype = constants.application_json
         res.status_code = 200
         return res
     else:
-        raise APIError(ERR_405_NO_METHOD)
\ No newline at end of file
+        raise APIError(ERR_405_NO_METHOD)
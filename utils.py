@@ -1,7 +1,15 @@
-from flask import request
-from google.cloud import datastore
+import hashlib
+import json
+from flask import request, make_response
+import random
+import time
+from urllib.parse import urlencode
 import constants
+from db import client, new_entity
 from API_errors import *
+from cache import entity_cache, page_cache
+from metrics import span
+from reprs import BoatRepr, CarrierRef, LoadRef, LoadRepr, MISSING, encode, links
 
 class APIError(Exception):
     def __init__(self, e):
@@ -10,59 +18,581 @@ class APIError(Exception):
 
 # API helper functions
 
-client = datastore.Client()
+def dumps(data):
+    """Serialize a response body, timed as part of the request's metrics"""
+    with span("serialize"):
+        return encode(data)
 
 def get_user_from_sub(sub):
-    """Get the user ID for the provided owner"""
-    query = client.query(kind=constants.users)
-    query.add_filter("sub", "=", sub)
-    user = list(query.fetch(limit=1))[0]
+    """Get the user entity for the provided owner, which is keyed by its sub"""
+    cache_key = (constants.users, sub)
+    user = entity_cache.get_multi([cache_key]).get(cache_key)
+    if user is None:
+        user = client.get(client.key(constants.users, sub))
+        if user is not None:
+            entity_cache.set_multi([user])
     return user
 
+def update_user_boats(sub, add=(), remove=(), name=None):
+    """Add and remove boat ids on the owner's user entity in one transaction.
+
+    The user entity is created if the owner has not logged in through
+    /userinfo yet.
+    """
+    user_key = client.key(constants.users, sub)
+
+    def update():
+        user = client.get(user_key)
+        if user is None:
+            user = new_entity(user_key)
+            user.update({"sub": sub, "name": name, "boats": []})
+        user["boats"] = [boat for boat in user["boats"] if boat not in remove]
+        user["boats"].extend(add)
+        client.put(user)
+
+    run_in_transaction(client, update)
+    invalidate(user_key)
+
 def validate_content_type(req):
     """Validate that the request format is application/json"""
     if req.content_type != 'application/json':
         raise APIError(ERR_406_INVALID_MIME)
 
+def get_batch_content(req):
+    """Read a list of objects from a JSON array or NDJSON request body"""
+    try:
+        if req.mimetype == constants.application_ndjson:
+            lines = req.get_data(as_text=True).splitlines()
+            content = [json.loads(line) for line in lines if line.strip()]
+        elif req.mimetype == constants.application_json:
+            content = json.loads(req.get_data(as_text=True))
+        else:
+            raise APIError(ERR_406_INVALID_MIME)
+    except ValueError:
+        raise APIError(ERR_400_INVALID_ATTR)
+    if not isinstance(content, list) or not all(isinstance(item, dict) for item in content):
+        raise APIError(ERR_400_INVALID_ATTR)
+    return content
+
+def check_volume(volume):
+    """Return volume if it is a number; boats and owners keep running totals of it"""
+    if isinstance(volume, bool) or not isinstance(volume, (int, float)):
+        raise APIError(ERR_400_INVALID_ATTR)
+    return volume
+
+def counted_volume(load):
+    """A load's volume as it counts towards boat and owner totals.
+
+    Loads created before volumes were checked can hold any JSON value;
+    those count as 0 until they are given a numeric volume.
+    """
+    volume = load.get("volume")
+    if isinstance(volume, bool) or not isinstance(volume, (int, float)):
+        return 0
+    return volume
+
 def authorize_boat_owner(payload, boat):
     # check that owner of received JWT matches that of the boat
     if payload['sub'] != boat['owner']:
         raise APIError(ERR_403_BOAT_OWNER)
 
+# get_load and get_boat read through the entity cache, which can be up to
+# ENTITY_CACHE_TTL seconds behind. Use them to check existence and
+# ownership; anything that is written back must be read again with
+# client.get inside the transaction that writes it.
+
 def get_load(load_id):
     load_key = client.key(constants.loads, int(load_id))
-    load = client.get(key=load_key)
+    load = get_multi(constants.loads, [load_key.id]).get(load_key.id)
     return load_key, load
 
 def get_boat(boat_id):
     boat_key = client.key(constants.boats, int(boat_id))
-    boat = client.get(key=boat_key)
+    boat = get_multi(constants.boats, [boat_key.id]).get(boat_key.id)
     return boat_key, boat
 
-def create_boat_repr(boat):
-    boat["id"] = boat.key.id  # Add id value to response
-    boat["self"] = request.url_root + 'boats/' + str(boat.key.id)  # Add boat URL to response
-    # Add load representation to response
-    rep_loads = []
-    for load in boat["loads"]:
-        temp = {
-            "id": load,
-            "item": get_load(load)[1]["item"],
-            "self": request.host_url + 'loads/' + str(load)
-            }
-        rep_loads.append(temp)
-    boat["loads"] = rep_loads
-    return boat
-
-def create_load_repr(load):
-    load["id"] = load.key.id  # Add id value to response
-    load["self"] = request.url_root + 'loads/' +  str(load.key.id) # Add URL to response
-    # Create carrier representation
-    if load["carrier"]:
-        temp = {
-            "id": load["carrier"],
-            "name": get_boat(load["carrier"])[1]["name"],
-            "self": request.host_url + 'boats/' + str(load["carrier"])
-        }
-        load["carrier"] = temp
-    return load
\ No newline at end of file
+def touch(*entities):
+    """Bump the version of entities that are about to be written.
+
+    Every write to a boat or load goes through here, so a version
+    identifies one state of the entity and ETags can be derived from it.
+    """
+    for entity in entities:
+        entity["version"] = entity.get("version", 0) + 1
+        # Never queried, so they do not need index writes
+        entity.exclude_from_indexes = set(entity.exclude_from_indexes) | set(constants.unindexed)
+
+def fingerprint(entity):
+    # Key and version; partial entities from projection queries have no
+    # version, so their values are used instead
+    if "version" in entity:
+        state = entity["version"]
+    else:
+        state = sorted((name, repr(value)) for name, value in entity.items())
+    return [entity.key.kind, entity.key.id_or_name, state]
+
+def make_etag(entities, fields=None, expand=(), related=None, extra=None):
+    """Strong ETag over everything a representation is built from.
+
+    related holds the entities an expansion reads and extra any other
+    data in the body, such as the next page link. The request URL is
+    included because the body carries links built from it.
+    """
+    parts = [
+        request.base_url,
+        sorted(fields) if fields is not None else None,
+        sorted(expand),
+        [fingerprint(entity) for entity in entities],
+        sorted(fingerprint(entity) for entity in (related or {}).values()),
+        extra,
+    ]
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+def not_modified(req, etag):
+    """Return a 304 response if the client already holds this representation"""
+    if req.if_none_match.contains_weak(etag):
+        res = make_response('', 304)
+        res.set_etag(etag)
+        return res
+    return None
+
+def invalidate(*items):
+    """Drop entities or keys from the entity cache after they are written"""
+    keys = []
+    for item in items:
+        key = getattr(item, "key", item)
+        keys.append((key.kind, key.id_or_name))
+    entity_cache.invalidate(keys)
+
+def invalidate_owner(sub):
+    """Retire every cached list page of an owner after a write that affects them"""
+    page_cache.bump(sub)
+
+def fetch_page(query, limit, cursor=None, offset=0):
+    """Fetch one page of query results.
+
+    Returns the entities and the cursor for the following page, or None
+    if Datastore reported no further results.
+    """
+    from google.api_core.exceptions import BadRequest
+    try:
+        iterator = query.fetch(limit=limit, offset=offset, start_cursor=cursor)
+        results = list(next(iterator.pages))
+    except (ValueError, BadRequest):
+        # Malformed cursor supplied by the client
+        raise APIError(ERR_400_INVALID_ATTR)
+    next_cursor = iterator.next_page_token
+    if next_cursor and not isinstance(next_cursor, str):
+        next_cursor = next_cursor.decode()
+    return results, next_cursor
+
+def page_url(base_url, **params):
+    """Build the url of a result page from its query parameters"""
+    return base_url + "?" + urlencode(params)
+
+def export_ndjson(query, represent):
+    """Stream every result of a query as NDJSON, one batch at a time.
+
+    A single query iterator walks the results with Datastore's own
+    cursors. represent turns a batch of entities into representations,
+    so related entities are resolved once per batch.
+    """
+    for page in query.fetch().pages:
+        entities = list(page)
+        if entities:
+            yield "".join(dumps(data) + "\n" for data in represent(entities))
+
+def iter_pages(query, page_size):
+    """Walk every result of a query one page at a time using cursors"""
+    cursor = None
+    while True:
+        results, cursor = fetch_page(query, page_size, cursor)
+        if results:
+            yield results
+        if not cursor or len(results) < page_size:
+            return
+
+def run_in_transaction(ds_client, fn, retries=constants.transaction_retries):
+    """Run fn inside a Datastore transaction, retrying when it is aborted by contention.
+
+    fn must do all of its reads and writes through ds_client. Any other
+    exception rolls the transaction back and is raised unchanged.
+    """
+    from google.api_core.exceptions import Aborted
+    for attempt in range(retries + 1):
+        try:
+            with ds_client.transaction():
+                return fn()
+        except Aborted:
+            if attempt == retries:
+                raise
+            # Exponential backoff with jitter before retrying
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+def get_multi(kind, ids, copy=True):
+    """Fetch entities of one kind by id through the entity cache, batching the lookups.
+
+    Returns a dict of id to entity; ids with no entity are left out. With
+    copy=False, cached entities are shared and must not be modified.
+    """
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    cached = entity_cache.get_multi([(kind, i) for i in ids], copy=copy)
+    found = {i: entity for (_, i), entity in cached.items()}
+    ids = [i for i in ids if i not in found]
+    for start in range(0, len(ids), constants.max_lookup_keys):
+        chunk = ids[start:start + constants.max_lookup_keys]
+        keys = [client.key(kind, i) for i in chunk]
+        entities = client.get_multi(keys)
+        entity_cache.set_multi(entities)
+        for entity in entities:
+            found[entity.key.id] = entity
+    return found
+
+def allocate_keys(kind, count):
+    """Reserve complete keys for count new entities of a kind"""
+    keys = []
+    incomplete_key = client.key(kind)
+    for start in range(0, count, constants.max_mutations):
+        keys.extend(client.allocate_ids(incomplete_key, min(constants.max_mutations, count - start)))
+    return keys
+
+def put_multi(entities):
+    """Write entities in as few commits as Datastore allows"""
+    for start in range(0, len(entities), constants.max_mutations):
+        client.put_multi(entities[start:start + constants.max_mutations])
+    invalidate(*entities)
+
+def load_summary(load):
+    """The copy of a load that its carrier keeps in load_summaries"""
+    return {"id": load.key.id, "item": load["item"]}
+
+def link_load(boat, load):
+    """Put load on boat, keeping the copies each entity holds of the other.
+
+    Boats written before load_summaries and load_volume existed are left
+    without them until backfill_summaries.py and reconcile_stats.py have
+    upgraded them.
+    """
+    load["carrier"] = boat.key.id
+    load["carrier_name"] = boat["name"]
+    boat["loads"].append(load.key.id)
+    if "load_summaries" in boat:
+        boat["load_summaries"].append(load_summary(load))
+    if "load_volume" in boat:
+        boat["load_volume"] += counted_volume(load)
+
+def unlink_load(boat, load):
+    """Take a load off boat along with its summary and volume"""
+    load_id = load.key.id
+    boat["loads"] = [i for i in boat["loads"] if i != load_id]
+    if "load_summaries" in boat:
+        boat["load_summaries"] = [summary for summary in boat["load_summaries"] if summary["id"] != load_id]
+    if "load_volume" in boat:
+        boat["load_volume"] -= counted_volume(load)
+
+def boat_volume(boat):
+    """Total volume of the loads on boat.
+
+    Boats that reconcile_stats.py has not upgraded yet have no load_volume,
+    so their loads are looked up and summed.
+    """
+    if "load_volume" in boat:
+        return boat["load_volume"]
+    loads = get_multi(constants.loads, boat["loads"], copy=False)
+    return sum(counted_volume(load) for load in loads.values() if load["carrier"] == boat.key.id)
+
+def update_boat(boat_id, updates):
+    """Apply attribute updates to a boat, copying a new name onto the loads it carries.
+
+    The boat is written with the first chunk of loads; a boat carrying
+    more loads than one commit allows is renamed over several
+    transactions.
+    """
+    boat_key = client.key(constants.boats, int(boat_id))
+    chunk_size = constants.max_mutations - 1
+    renamed = "name" in updates
+
+    def update(start):
+        boat = client.get(boat_key)
+        if not boat:
+            raise APIError(ERR_404_INVALID_ID)
+        changed = []
+        if start == 0:
+            boat.update(updates)
+            changed.append(boat)
+        chunk = boat["loads"][start:start + chunk_size] if renamed else []
+        for load in client.get_multi([client.key(constants.loads, i) for i in chunk]):
+            if load["carrier"] == boat_key.id and load.get("carrier_name") != boat["name"]:
+                load["carrier_name"] = boat["name"]
+                changed.append(load)
+        touch(*changed)
+        client.put_multi(changed)
+        return changed, len(chunk) == chunk_size
+
+    start = 0
+    more = True
+    while more:
+        changed, more = run_in_transaction(client, lambda: update(start))
+        invalidate(*changed)
+        start += chunk_size
+
+def get_fields(req, allowed):
+    """Read ?fields= into the set of attributes to return, or None for all of them.
+
+    id and self are always returned.
+    """
+    value = req.args.get("fields")
+    if value is None:
+        return None
+    fields = {name.strip() for name in value.split(",") if name.strip()}
+    if not fields <= set(allowed):
+        raise APIError(ERR_400_INVALID_QUERY)
+    return fields | {"id", "self"}
+
+def get_expand(req, allowed):
+    """Read ?expand= into the set of related entities to look up"""
+    expand = {name.strip() for name in req.args.get("expand", "").split(",") if name.strip()}
+    if not expand <= set(allowed):
+        raise APIError(ERR_400_INVALID_QUERY)
+    return expand
+
+def list_params(req):
+    """Query parameters that shape a list, carried onto its next page links"""
+    return {name: value for name, value in req.args.items() if name not in ("limit", "offset", "cursor")}
+
+def wanted(fields, name):
+    return fields is None or name in fields
+
+# Filters and sort orders for list queries. ?<property>=<value> filters by
+# equality and ?<property>_gt=, _gte=, _lt= or _lte= by comparison; ?sort=
+# lists properties to order by, each prefixed with - for descending. Values
+# are converted to the type the property is stored as.
+
+def _carrier(value):
+    return None if value == "null" else int(value)
+
+FILTERS = {
+    constants.boats: {"name": str, "length": int, "date_built": str},
+    constants.loads: {"volume": int, "item": str, "creation_date": str, "carrier": _carrier},
+}
+
+FILTER_OPERATORS = {"": "=", "_gt": ">", "_gte": ">=", "_lt": "<", "_lte": "<="}
+
+LIST_PARAMS = ("limit", "offset", "cursor", "fields", "expand", "sort")
+
+# Composite indexes in index.yaml that filtered or sorted lists can use, as
+# the set of equality-filtered properties and the sort orders that follow
+# them. Lists needing an index not listed here are rejected.
+LIST_INDEXES = {
+    constants.boats: {
+        (frozenset(["owner"]), ("name",)),
+        (frozenset(["owner"]), ("-name",)),
+        (frozenset(["owner"]), ("length",)),
+        (frozenset(["owner"]), ("-length",)),
+        (frozenset(["owner"]), ("date_built",)),
+        (frozenset(["owner"]), ("-date_built",)),
+    },
+    constants.loads: {
+        (frozenset(["carrier"]), ("creation_date",)),
+        (frozenset(["carrier"]), ("-creation_date",)),
+        (frozenset(["carrier"]), ("volume",)),
+        (frozenset(["carrier"]), ("-volume",)),
+    },
+}
+
+def index_supported(kind, equalities, orders):
+    """Whether Datastore has an index for a query with these filters and orders"""
+    if not orders:
+        # Built-in indexes, merged when there are several equality filters
+        return True
+    if not equalities and len(orders) == 1:
+        # Built-in single property index, which serves either direction
+        return True
+    return (frozenset(equalities), tuple(orders)) in LIST_INDEXES[kind]
+
+def apply_list_query(req, query, fixed=()):
+    """Add the filters and sort orders in req's query string to query.
+
+    fixed names properties the handler already filters on by equality, such
+    as a boat's owner. Unknown parameters, bad values and combinations no
+    index supports raise ERR_400_INVALID_QUERY before any RPC is made.
+    Returns True if anything was added.
+    """
+    converters = FILTERS[query.kind]
+    filters = []
+    for name, value in req.args.items():
+        if name in LIST_PARAMS:
+            continue
+        for suffix, operator in FILTER_OPERATORS.items():
+            prop = name[:len(name) - len(suffix)] if suffix else name
+            if name.endswith(suffix) and prop in converters:
+                try:
+                    filters.append((prop, operator, converters[prop](value)))
+                except ValueError:
+                    raise APIError(ERR_400_INVALID_QUERY)
+                break
+        else:
+            raise APIError(ERR_400_INVALID_QUERY)
+
+    orders = [name.strip() for name in req.args.get("sort", "").split(",") if name.strip()]
+    if not set(name.lstrip("-") for name in orders) <= set(converters):
+        raise APIError(ERR_400_INVALID_QUERY)
+    if not filters and not orders:
+        return False
+
+    equalities = set(fixed) | {prop for prop, operator, _ in filters if operator == "="}
+    inequalities = {prop for prop, operator, _ in filters if operator != "="}
+    # Ordering by a property filtered by equality has no effect
+    orders = [name for name in orders if name.lstrip("-") not in equalities]
+    if len(inequalities) > 1 or inequalities & equalities:
+        raise APIError(ERR_400_INVALID_QUERY)
+    if inequalities:
+        # Datastore orders by the compared property first
+        prop = inequalities.pop()
+        if not orders:
+            orders = [prop]
+        elif orders[0].lstrip("-") != prop:
+            raise APIError(ERR_400_INVALID_QUERY)
+    if not index_supported(query.kind, equalities, orders):
+        raise APIError(ERR_400_INVALID_QUERY)
+
+    for prop, operator, value in filters:
+        query.add_filter(prop, operator, value)
+    query.order = orders
+    return True
+
+# Stored property sets that a list query can project instead of reading whole
+# entities. Each one needs an index in index.yaml, or a built-in single
+# property index.
+PROJECTIONS = {
+    constants.boats: {
+        frozenset(["name"]),
+        frozenset(["name", "length", "date_built"]),
+    },
+    constants.loads: {
+        frozenset(["volume"]),
+        frozenset(["item"]),
+        frozenset(["creation_date"]),
+        frozenset(["carrier"]),
+    },
+}
+
+def project_query(query, fields, stored):
+    """Restrict query to the stored properties named in fields, where an index allows it.
+
+    stored lists the properties that come from the entity itself. A query
+    needing none of them becomes keys-only. Returns True if the query now
+    returns partial entities.
+    """
+    if fields is None:
+        return False
+    properties = frozenset(fields) & frozenset(stored)
+    if not properties:
+        query.keys_only()
+        return True
+    if properties in PROJECTIONS[query.kind]:
+        query.projection = sorted(properties)
+        return True
+    return False
+
+def boat_related(boats, fields=None, expand=()):
+    """Look up the loads that a page of boats expands to, by id.
+
+    Boats holding load_summaries need no lookup.
+    """
+    if wanted(fields, "loads") and "loads" in expand:
+        return get_multi(constants.loads, [load for boat in boats if "load_summaries" not in boat
+                                           for load in boat["loads"]], copy=False)
+    return {}
+
+def create_boat_reprs(boats, fields=None, expand=(), related=None):
+    """Build the representation of a page of boats.
+
+    Loads are returned as id and self links unless "loads" is expanded, in
+    which case their items come from the boat's load_summaries, or from
+    one batched lookup for boats that have not been backfilled. related
+    may pass in the result of boat_related if it was already looked up.
+    The boats themselves are left unchanged.
+    """
+    urls = links()
+    expand_loads = "loads" in expand
+    show_loads = wanted(fields, "loads")
+    loads = boat_related(boats, fields, expand) if related is None else related
+    reprs = []
+    for boat in boats:
+        rep_loads = MISSING
+        if show_loads and "loads" in boat:
+            summaries = boat.get("load_summaries")
+            if summaries is not None:
+                summaries = {summary["id"]: summary["item"] for summary in summaries}
+            rep_loads = []
+            for load in boat["loads"]:
+                item = MISSING
+                if expand_loads and summaries is not None:
+                    item = summaries.get(load)
+                elif expand_loads:
+                    load_entity = loads.get(int(load))
+                    item = load_entity["item"] if load_entity else None
+                rep_loads.append(LoadRef(id=load, item=item, self=urls.loads + str(load)))
+        reprs.append(BoatRepr(
+            fields,
+            id=boat.key.id,
+            name=boat.get("name", MISSING),
+            length=boat.get("length", MISSING),
+            date_built=boat.get("date_built", MISSING),
+            owner=boat.get("owner", MISSING),
+            loads=rep_loads,
+            self=urls.boats + str(boat.key.id)))
+    return reprs
+
+def create_boat_repr(boat, fields=None, expand=(), related=None):
+    return create_boat_reprs([boat], fields, expand, related)[0]
+
+def load_related(loads, fields=None, expand=()):
+    """Look up the carrier boats that a page of loads expands to, by id.
+
+    Loads holding carrier_name need no lookup.
+    """
+    if wanted(fields, "carrier") and "carrier" in expand:
+        return get_multi(constants.boats, [load["carrier"] for load in loads
+                                           if load["carrier"] and "carrier_name" not in load],
+                         copy=False)
+    return {}
+
+def create_load_reprs(loads, fields=None, expand=(), related=None):
+    """Build the representation of a page of loads.
+
+    The carrier is returned as an id and self link unless "carrier" is
+    expanded, in which case its name comes from the load's carrier_name,
+    or from one batched lookup for loads that have not been backfilled.
+    related may pass in the result of load_related if it was already
+    looked up. The loads themselves are left unchanged.
+    """
+    urls = links()
+    expand_carrier = "carrier" in expand
+    show_carrier = wanted(fields, "carrier")
+    boats = load_related(loads, fields, expand) if related is None else related
+    reprs = []
+    for load in loads:
+        carrier = load.get("carrier", MISSING)
+        # Create carrier representation
+        if show_carrier and carrier:
+            name = MISSING
+            if expand_carrier and load.get("carrier_name") is not None:
+                name = load["carrier_name"]
+            elif expand_carrier:
+                boat = boats.get(int(carrier))
+                name = boat["name"] if boat else None
+            carrier = CarrierRef(id=carrier, name=name, self=urls.boats + str(carrier))
+        reprs.append(LoadRepr(
+            fields,
+            id=load.key.id,
+            volume=load.get("volume", MISSING),
+            carrier=carrier,
+            item=load.get("item", MISSING),
+            creation_date=load.get("creation_date", MISSING),
+            self=urls.loads + str(load.key.id)))
+    return reprs
+
+def create_load_repr(load, fields=None, expand=(), related=None):
+    return create_load_reprs([load], fields, expand, related)[0]